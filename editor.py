@@ -1,9 +1,15 @@
 #! python3
 """Editor's collection of wxpj.
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import threading
+import time
+import os
 import numpy as np
 from numpy import pi, cos, sin
-from numpy.fft import fft2, fftshift
+from numpy.fft import fftshift
 import cv2
 from matplotlib import pyplot as plt
 from matplotlib import cm
@@ -34,12 +40,65 @@ def imcv(src):
     return src
 
 
-def imconv(src, hi=0, lo=0):
+def cutoff_levels(src, hi=0, lo=0, maxsamples=0x100000):
+    """Levels (a, b) with cutoff hi/lo % of src.
+    
+    The percentiles are estimated from subsampled pixels (maxsamples),
+    using the histogram for uint16 input instead of sorting.
+    """
+    if not (hi or lo):
+        return src.min(), src.max()
+    h, w = src.shape[:2]
+    k = max(1, int(np.sqrt(h * w / maxsamples)))
+    sub = src[::k, ::k].ravel() # subsampled copy
+    if src.dtype in (np.uint8, np.uint16):
+        cdf = np.bincount(sub, minlength=256).cumsum()
+        a = np.searchsorted(cdf, cdf[-1] * lo/100, side='right') if lo else src.min()
+        b = np.searchsorted(cdf, cdf[-1] * (100-hi)/100) if hi else src.max()
+    else:
+        a = np.percentile(sub, lo) if lo else src.min()
+        b = np.percentile(sub, 100-hi) if hi else src.max()
+    return a, b
+
+
+@lru_cache(maxsize=16)
+def lookup_table(a, b, gamma=1, n=0x10000):
+    """Lookup table <uint8> of n entries mapping levels [a:b] to [0:255].
+    
+    >>> lut[x] = 255 * ((x-a) / (b-a)) ** gamma
+    
+    The tables are cached for each (a, b, gamma, n) (read-only).
+    The gamma is applied in float before quantizing to 8 bits.
+    """
+    x = np.arange(n, dtype=np.float64)
+    y = (x - a) / ((b - a) if a < b else 255)
+    lut = np.uint8(np.round(255 * np.clip(y, 0, 1) ** gamma))
+    lut.setflags(write=False)
+    return lut
+
+
+def imconv(src, hi=0, lo=0, out=None, gamma=1):
     """Convert buffer to dst<uint8> with cutoff hi/lo %.
     
     >>> dst = (src-a) * 255 / (b-a)
+    
+    Args:
+        out   : output buffer <uint8> of the same shape (optional)
+        gamma : gamma correction of the output
+    
+    Note:
+        uint8 input is returned as it is (hi/lo are not applied),
+        except for the gamma correction.
+        uint16 input is mapped using the cached lookup table in a single
+        pass (np.take). The others are rounded and saturated in a single
+        pass (cv2.addWeighted).
     """
     if src.dtype == np.uint8:
+        if gamma != 1:
+            return cv2.LUT(src, lookup_table(0, 255, gamma, 0x100), dst=out)
+        if out is not None:
+            np.copyto(out, src)
+            return out
         return src
     
     if src.dtype in (np.complex64, np.complex128): # fft pattern
@@ -51,22 +110,27 @@ def imconv(src, hi=0, lo=0):
         ## return y.astype(src.dtype)
         src = cv2.cvtColor(src, cv2.COLOR_RGB2GRAY) # rgb2gray
     
-    a = np.percentile(src, lo) if lo else src.min()
-    b = np.percentile(src, 100-hi) if hi else src.max()
+    src = imcv(src)
+    if src.dtype == np.uint16:
+        a, b = map(int, cutoff_levels(src, hi, lo))
+        return np.take(lookup_table(a, b, gamma), src, out=out)
     
+    a, b = map(float, cutoff_levels(src, hi, lo))
     r = (255 / (b - a)) if a < b else 1
-    img = np.uint8((src - a) * r) # copy buffer
-    img[src < a] = 0
-    img[src > b] = 255
-    return img
+    if gamma != 1: # in float before quantizing
+        y = np.clip((src - a) * (r / 255), 0, 1, dtype=np.float32)
+        return cv2.convertScaleAbs(y ** gamma, dst=out, alpha=255)
+    return cv2.addWeighted(src, r, src, 0, -a * r, dst=out, dtype=cv2.CV_8U)
 
 
 ## --------------------------------
 ## maplotlib (in-shell use only)
 ## --------------------------------
 
-def imshow(src):
+def imshow(src, hi=0, lo=0, gamma=1):
     plt.clf()
+    if hi or lo or gamma != 1:
+        src = imconv(src, hi, lo, gamma=gamma)
     plt.imshow(src, cmap=cm.gray)
     plt.grid(True)
     plt.show()
@@ -125,36 +189,156 @@ def grad2(src, ksize=5):
     return cv2.Laplacian(src, cv2.CV_32F, ksize=ksize)
 
 
+## --------------------------------
+## FFT service (real-input transforms)
+## --------------------------------
+
+class FFTService(object):
+    """Shared FFT service of real-input transforms.
+    
+    The backend is pyFFTW (if installed), scipy.fft, or numpy.fft (fallback).
+    Plans are reused for the same shapes; the pyFFTW plans (with their
+    aligned buffers) are kept per thread so that the service is reentrant.
+    
+    Args:
+        workers : number of threads (-1: all cores)
+        backend : 'pyfftw', 'scipy', or 'numpy' (default: the best one)
+    """
+    def __init__(self, workers=-1, backend=None):
+        if backend is None:
+            for backend in ('pyfftw', 'scipy', 'numpy'):
+                try:
+                    __import__(backend)
+                    break
+                except ImportError:
+                    pass
+        self.backend = backend
+        self.workers = workers
+        self._local = threading.local()
+    
+    def __repr__(self):
+        return "{}(backend={!r}, workers={})".format(
+            self.__class__.__name__, self.backend, self.workers)
+    
+    @property
+    def threads(self):
+        return self.workers if self.workers > 0 else (os.cpu_count() or 1)
+    
+    def _plan(self, kind, shape, dtype, s, axes):
+        plans = self._local.__dict__.setdefault('plans', {})
+        key = (kind, shape, dtype, s, axes)
+        try:
+            return plans[key]
+        except KeyError:
+            import pyfftw
+            a = pyfftw.empty_aligned(shape, dtype)
+            builder = getattr(pyfftw.builders, kind)
+            plans[key] = plan = builder(a, s=s, axes=axes, threads=self.threads,
+                                        planner_effort='FFTW_ESTIMATE')
+            return plan
+    
+    def _call(self, kind, a, s, axes, copy):
+        if self.backend == 'pyfftw':
+            plan = self._plan(kind, a.shape, a.dtype, s, axes)
+            ret = plan(a)
+            return ret.copy() if copy else ret # output buffer is reused
+        if self.backend == 'scipy':
+            from scipy import fft
+            return getattr(fft, kind)(a, s, axes, workers=self.workers)
+        return getattr(np.fft, kind)(a, s, axes)
+    
+    def rfftn(self, src, s=None, axes=None, copy=True):
+        """Real-input FFT; float32 (or int) src gives complex64."""
+        src = np.asarray(src)
+        if src.dtype.kind in 'biu' or src.dtype == np.float16:
+            src = src.astype(np.float32)
+        if s is not None:
+            s = tuple(s)
+        if axes is not None:
+            axes = tuple(axes)
+        return self._call('rfftn', src, s, axes, copy)
+    
+    def irfftn(self, F, s, axes=None, copy=True):
+        """Inverse of rfftn; s is the shape of the real output."""
+        if axes is not None:
+            axes = tuple(axes)
+        return self._call('irfftn', F, tuple(s), axes, copy)
+    
+    def rfft2(self, src, s=None, copy=True):
+        return self.rfftn(src, s, axes=(-2,-1), copy=copy)
+    
+    def irfft2(self, F, s, copy=True):
+        return self.irfftn(F, s, axes=(-2,-1), copy=copy)
+
+fft_service = FFTService()
+
+
+def _hermitian_full(half, w):
+    """Restore the full (h, w) spectrum of a real image from the half (h, w//2+1).
+    
+    For absolute values or powers P(-k) = P(k).
+    """
+    h = half.shape[0]
+    dst = np.empty((h, w), dtype=half.dtype)
+    dst[:, :w//2+1] = half
+    j = np.arange(w//2+1, w)
+    dst[:, j] = half[(-np.arange(h)) % h][:, w-j]
+    return dst
+
+
+def fft_spectrum(src):
+    """Amplitude spectrum |fft2(src)| (fftshift-ed) using the real-input FFT."""
+    h, w = src.shape
+    F = fft_service.rfft2(src, copy=False)
+    return fftshift(_hermitian_full(np.abs(F), w))
+
+
 ## --------------------------------
 ## Image analysis using FFT / misc.
 ## --------------------------------
 
+@lru_cache(maxsize=8)
+def radius_index(h, w, rmax):
+    """Radius index map [pix] from the fft center (w//2, h//2).
+    
+    Returns:
+        idx     : integer radius of each pixel (read-only);
+                  pixels outside rmax are labelled with the last bin.
+        counts  : number of pixels in each bin
+    """
+    y, x = np.ogrid[-(h//2):h-h//2, -(w//2):w-w//2]
+    r = np.hypot(y, x)
+    nbins = int(rmax) + 1
+    idx = np.rint(r).astype(np.intp)
+    idx[r > rmax] = nbins
+    counts = np.bincount(idx.ravel(), minlength=nbins+1)
+    idx.setflags(write=False)
+    counts.setflags(write=False)
+    return idx, counts
+
+
 def enhanced_fft(src, ratio=1):
-    """FFT intensity image with pseudo background subtraction using cv2.linearPolar.
+    """FFT intensity image with pseudo background subtraction.
+    
+    The radial mean of the log intensity is subtracted as the background.
     
     Args:
-        ratio: ratio of the polar-transform radius to n,
+        ratio: ratio of the background radius to n,
                where the src shape is (2n, 2n).
+               The outside of the radius is set to zero.
     """
-    src = fftshift(fft2(src))   # fft2
-    buf = np.log(1 + abs(src))  # log intensity
+    buf = np.log(1 + fft_spectrum(src))  # log intensity
     h, w = buf.shape            # shape: (2n, 2n)
     n = h//2
     rmax = n * ratio
-    buf = cv2.linearPolar(buf, (w/2, h/2), rmax, cv2.WARP_FILL_OUTLIERS)
-    buf -= sum(buf) / h # バックグラウンド(ぽい)強度を引いてみる
+    idx, counts = radius_index(h, w, rmax)
     
-    buf = cv2.linearPolar(buf, (w/2, h/2), rmax, cv2.WARP_INVERSE_MAP)
-    ## Note:
-    ##     ↓逆変換を何度か呼び出すと変な結果になるバグ？▲θ=±πの部分が回復しない
-    ## N = np.arange(-n, n, dtype=np.float32),
-    ## X, Y = np.meshgrid(N, N)
-    ## map_r = w/rmax * np.hypot(Y, X)
-    ## map_t = (pi + np.arctan2(Y, X)) * h/2 /pi
-    ## buf = cv2.remap(buf.astype(np.float32), map_r, map_t,
-    ##                 cv2.INTER_CUBIC, cv2.WARP_FILL_OUTLIERS)
-    
-    dst = np.exp(buf) - 1 # log --> exp で戻す
+    ## バックグラウンド(ぽい)強度を引いてみる
+    mean = np.bincount(idx.ravel(), buf.ravel()) / np.maximum(counts, 1)
+    buf -= mean.astype(buf.dtype)[idx]
+    
+    dst = np.expm1(buf, out=buf) # log --> exp で戻す
+    dst[idx == len(counts)-1] = 0 # outside of rmax
     return dst
 
 
@@ -167,6 +351,63 @@ def fftcrop(src, maxsize=2048, center=None):
     return src[y-n:y+n, x-n:x+n]
 
 
+_tile_fft = FFTService(workers=1) # for tiles transformed in parallel
+
+
+def welch_spectrum(src, size=1024, overlap=0.5, batch=8, workers=4):
+    """Power spectrum averaged over overlapping tiles (Welch's method).
+    
+    The whole src image is covered with tiles that are windowed (Hann)
+    and transformed in batches with real FFTs.
+    The batches are processed by a pool of threads (numpy/FFT release the GIL).
+    
+    Args:
+        src     : source image
+        size    : tile size (2n)
+        overlap : overlap ratio of neighbouring tiles
+        batch   : number of tiles transformed at once
+        workers : number of threads (-1: all cores)
+                  Each thread takes about batch * size**2 * 16 bytes.
+    
+    Returns:
+        fftshift-ed power spectrum of shape (size, size)
+    
+    Note:
+        The frequency axis is scaled by the tile size, i.e.,
+        the radius r [pix] corresponds to r/size [1/pix].
+    """
+    h, w = src.shape
+    n = min(size, h, w) // 2 * 2
+    step = max(1, int(n * (1 - overlap)))
+    windows = np.lib.stride_tricks.sliding_window_view(src, (n, n))[::step, ::step]
+    iy, ix = np.indices(windows.shape[:2]).reshape(2, -1) # tile origins
+    
+    win = np.hanning(n).astype(np.float32)
+    win = np.outer(win, win)
+    
+    def _power(k):
+        tiles = windows[iy[k:k+batch], ix[k:k+batch]].astype(np.float32)
+        tiles -= tiles.mean(axis=(1,2), keepdims=True)
+        tiles *= win
+        F = service.rfft2(tiles, copy=False)
+        return (F.real**2 + F.imag**2).sum(axis=0)
+    
+    if workers < 0:
+        workers = os.cpu_count() or 1
+    batches = range(0, len(iy), batch)
+    if workers == 1 or len(batches) == 1:
+        service = fft_service
+        acc = sum(map(_power, batches))
+    else:
+        service = _tile_fft
+        with ThreadPoolExecutor(min(workers, len(batches))) as executor:
+            acc = sum(executor.map(_power, batches))
+    acc = acc / len(iy)
+    
+    ## Restore the full spectrum using the Hermitian symmetry P(-k) = P(k).
+    return fftshift(_hermitian_full(acc, n))
+
+
 def crop(src, maxsize=256, center=None):
     """Crop ROI from src centered at (x, y)."""
     h, w = src.shape
@@ -180,18 +421,31 @@ def Corr(src, tmp, mode='same'):
     using an fft-based array flipped convolution (i.e. correlation).
     
     cf. cv2.phaseCorrelate: translational shifts between two images
+    
+    Note:
+        The result is equivalent to `signal.fftconvolve(src, tmp[::-1,::-1], mode)`.
     """
-    from scipy import signal
+    from scipy.fft import next_fast_len
 
     src = src.astype(np.float32) - src.mean()
     tmp = tmp.astype(np.float32) - tmp.mean()
-    if src.ndim == 1:
-        return signal.fftconvolve(src, tmp[::-1], mode)
+    ## *not-FFT-based* is too slow
+    ## return signal.convolve2d(src, tmp[::-1,::-1], mode='same')
+    ## return signal.correlate2d(src, tmp, mode='same', boundary='fill')
+    full = [n + m - 1 for n, m in zip(src.shape, tmp.shape)]
+    s = [next_fast_len(n, True) for n in full]
+    F = fft_service.rfftn(src, s) * fft_service.rfftn(tmp[(slice(None,None,-1),) * tmp.ndim], s)
+    dst = fft_service.irfftn(F, s)
+    if mode == 'full':
+        shape = full
+    elif mode == 'same':
+        shape = src.shape
+    elif mode == 'valid':
+        shape = [n - m + 1 for n, m in zip(src.shape, tmp.shape)]
     else:
-        ## *not-FFT-based* is too slow
-        ## return signal.convolve2d(src, tmp[::-1,::-1], mode='same')
-        ## return signal.correlate2d(src, tmp, mode='same', boundary='fill')
-        return signal.fftconvolve(src, tmp[::-1,::-1], mode)
+        raise ValueError("mode must be 'full', 'same', or 'valid'")
+    start = [(n - k) // 2 for n, k in zip(full, shape)]
+    return dst[tuple(slice(i, i+k) for i, k in zip(start, shape))]
 
 
 def match_pattern(src, tmp, method=cv2.TM_CCOEFF_NORMED):
@@ -244,6 +498,123 @@ def eval_corr_shift(src, tmp, crop=False, subpix=False):
     return dst, (dx, dy)
 
 
+@lru_cache(maxsize=8)
+def hann2d(h, w):
+    """2D Hann window <float32> (read-only)."""
+    win = np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)
+    win.setflags(write=False)
+    return win
+
+
+class PhaseCorrelator(object):
+    """Phase-correlation shift estimator against a template.
+    
+    The template spectrum is computed once and reused for every frame.
+    The frames are evaluated in float32 (no uint8 quantization), and the
+    sub-pixel shift is refined by the upsampled DFT around the peak
+    (cf. Guizar-Sicairos et al., Opt. Lett. 33, 156 (2008)).
+    
+    Args:
+        tmp      : template image
+        window   : apply a Hann window to reduce the edge effect
+        upsample : upsampling factor of the sub-pixel refinement
+                   (1: pixel precision)
+    """
+    def __init__(self, tmp, window=True, upsample=20):
+        self.shape = tmp.shape
+        self.window = hann2d(*self.shape) if window else None
+        self.upsample = upsample
+        self.spectrum = np.conj(fft_service.rfft2(self._prepare(tmp[None])[0]))
+    
+    def _prepare(self, frames):
+        buf = np.array(frames, dtype=np.float32) # copy
+        buf -= buf.mean(axis=(-2,-1), keepdims=True)
+        if self.window is not None:
+            buf *= self.window
+        return buf
+    
+    def __call__(self, src):
+        """Evaluate shift (dx, dy) [pix] of src from the template."""
+        return tuple(self.evaluate(src[None])[0])
+    
+    def evaluate(self, frames, batch=16, full_output=False):
+        """Evaluate shifts of many frames in batches.
+        
+        Args:
+            frames      : sequence (or 3D array) of images of the template shape
+            batch       : number of frames transformed at once
+            full_output : also return the (fftshift-ed) correlation images
+        
+        Returns:
+            shifts (N, 2) of (dx, dy) [pix] [and the correlation images]
+        """
+        h, w = self.shape
+        shifts = []
+        images = []
+        for k in range(0, len(frames), batch):
+            buf = self._prepare(frames[k:k+batch])
+            if buf.shape[1:] != self.shape:
+                raise ValueError("frame shape {} does not match the template {}"
+                                 .format(buf.shape[1:], self.shape))
+            R = fft_service.rfft2(buf, copy=False) * self.spectrum
+            R /= np.abs(R) + 1e-12 # cross-power spectrum
+            dst = fft_service.irfft2(R, (h, w))
+            n = dst.reshape(len(dst), -1).argmax(axis=1)
+            y, x = np.unravel_index(n, (h, w))
+            y = (y + h//2) % h - h//2 # wrap around to [-h/2, h/2)
+            x = (x + w//2) % w - w//2
+            xy = np.stack((x, y), axis=1).astype(float)
+            if self.upsample > 1:
+                xy = self._refine(R, xy)
+            shifts.append(xy)
+            if full_output:
+                images.append(fftshift(dst, axes=(-2,-1)))
+        shifts = np.concatenate(shifts) if shifts else np.empty((0, 2))
+        if full_output:
+            return shifts, np.concatenate(images)
+        return shifts
+    
+    def _refine(self, R, xy):
+        """Refine the shifts in the region of 1.5 pixels by the upsampled DFT.
+        
+        The half spectrum R of real images is used with the weights of
+        the Hermitian symmetry: c(x) = Re(sum_k' w(k) R(k) exp(2pi i k.x)).
+        """
+        h, w = self.shape
+        m = R.shape[-1]
+        wt = np.full(m, 2, dtype=np.float32)
+        wt[0] = 1
+        if w % 2 == 0:
+            wt[-1] = 1 # Nyquist
+        u = self.upsample
+        n = int(np.ceil(1.5 * u))
+        k = (np.arange(n) - n//2) / u
+        ky = np.fft.fftfreq(h)
+        kx = np.fft.rfftfreq(w)
+        px = xy[:,0,None] + k # sampling points (N, n)
+        py = xy[:,1,None] + k
+        Ey = np.exp(2j*pi * py[:,:,None] * ky).astype(np.complex64) # (N, n, h)
+        Ex = np.exp(2j*pi * kx[:,None] * px[:,None,:]).astype(np.complex64) # (N, m, n)
+        dst = (Ey @ (R * wt) @ Ex).real # (N, n, n)
+        j = dst.reshape(len(dst), -1).argmax(axis=1)
+        iy, ix = np.unravel_index(j, (n, n))
+        return np.stack((xy[:,0] + k[ix], xy[:,1] + k[iy]), axis=1)
+
+
+def eval_phase_shift(src, tmp, window=True, upsample=20):
+    """Evaluate shift [pix] of src from tmp (template) using phase correlation.
+    
+    For time series, use PhaseCorrelator to reuse the template spectrum.
+    
+    Returns:
+        dst (fftshift-ed phase correlation) and the shift (dx, dy)
+    """
+    pc = PhaseCorrelator(tmp, window, upsample)
+    shifts, dst = pc.evaluate(src[None], full_output=True)
+    dx, dy = shifts[0]
+    return dst[0], (dx, dy)
+
+
 ## --------------------------------
 ## Image analysis; Detect ellipses
 ## --------------------------------
@@ -373,6 +744,7 @@ def calc_ellipse(src, ellipse):
 
 def _qrsp(x, y):
     """x[3],y[3]: x,y 近接した３点から 2次式で極値の箇所を推定する．
+    y[i] は配列でもよい (複数の３点組を一括して評価する)．
     
     Returns:
         dx, dy : 中央位置 (x[1], y[1]) からの差分値
@@ -388,7 +760,7 @@ def _qrsp(x, y):
     ## cf. a,b,c = np.polyfit(x, y, 2)
     dx = -b/a/2
     dy = dx * b/2
-    return dx, dy, a<0, x0<dx<x2,
+    return dx, dy, a<0, (x0<dx) & (dx<x2),
 
 
 def find_local_extremum(x, y, max=True):
@@ -441,3 +813,100 @@ def find_local_extremum2d(src, max=True):
     if valid:
         return j+dx, i+dy, src[i,j]+dzx+dzy, valid
     return nx, ny, src[ny,nx], valid
+
+
+## --------------------------------
+## Fitting utilities
+## --------------------------------
+
+class FitReport(object):
+    """Progress report of least-squares fitting.
+    
+    Collects the iteration count, residual norm, and wall time
+    without any I/O in the residual function.
+    
+    Args:
+        handler  : called with the report at most once per interval
+        interval : minimum interval [s] of calling the handler
+    
+    >>> model.report = FitReport(lambda r: print(r), interval=0.5)
+    """
+    def __init__(self, handler=None, interval=0.2):
+        self.handler = handler
+        self.interval = interval
+        self.reset()
+    
+    def reset(self):
+        self.count = 0          # number of residual calls
+        self.points = 0         # number of residual points
+        self.norm = np.nan      # residual norm sqrt(sum(res**2))
+        self.elapsed = 0        # wall time [s]
+        self._start = self._last = time.perf_counter()
+    
+    def __call__(self, res):
+        self.count += 1
+        self.points = len(res)
+        self.norm = np.sqrt(np.dot(res, res))
+        t = time.perf_counter()
+        self.elapsed = t - self._start
+        if self.handler and t - self._last > self.interval:
+            self._last = t
+            self.handler(self)
+    
+    def __str__(self):
+        return "point({}): residual {:g} ({} calls, {:.3f} s)".format(
+                self.points, self.norm, self.count, self.elapsed)
+
+
+## --------------------------------
+## Cache utilities
+## --------------------------------
+
+class LRUCache(object):
+    """LRU cache of arrays with memory accounting.
+    
+    The least recently used items are evicted
+    when the total bytes of cached arrays exceed maxbytes.
+    
+    Args:
+        maxbytes : upper limit of the total bytes of cached arrays
+    
+    >>> cache = LRUCache(256e6)
+    >>> maps = cache.get(key, lambda: make_maps(*args))
+    """
+    def __init__(self, maxbytes=256e6):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def get(self, key, factory):
+        """Get the cached value of key, or create it by factory()."""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key][0]
+        value = factory()
+        if isinstance(value, np.ndarray):
+            nbytes = value.nbytes
+        else:
+            nbytes = sum(getattr(v, 'nbytes', 0) for v in value)
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = (value, nbytes)
+                self.nbytes += nbytes
+            while self.nbytes > self.maxbytes and len(self._data) > 1:
+                _key, (_v, n) = self._data.popitem(last=False)
+                self.nbytes -= n
+        return value
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
@@ -1,11 +1,10 @@
 #! python3
 """Gatan Camera module.
 """
-from datetime import datetime
 import time
 import threading
 
-from wxpj import Layer, Param, LParam, Button, Choice
+from wxpj import CameraLayer, Param, LParam, Button, ToggleButton, Choice
 from pyGatan import GatanSocket
 
 
@@ -87,7 +86,7 @@ class Camera(GatanSocket):
             return buf
 
 
-class Plugin(Layer):
+class Plugin(CameraLayer):
     """Gatan camera manager.
     """
     menukey = "Cameras/&Gatan camera ver.2"
@@ -113,6 +112,7 @@ class Plugin(Layer):
         )
         self.layout((
                 Button(self, "Capture", self.capture_ex, icon='camera'),
+                ToggleButton(self, "Prefetch", self.toggle_prefetch, icon='->'),
             ),
             row=2,
         )
@@ -173,32 +173,3 @@ class Plugin(Layer):
                 time.sleep(5)
             else:
                 self.camera.InsertCamera(0, False)
-    
-    def capture(self, view=False, **kwargs):
-        """Capture image.
-        
-        Args:
-            view    : If True, the buffer will be loaded into the graph view.
-            **kwargs: Additional attributes of the buffer frame.
-                      Used only if view is True.
-        """
-        if not self.camera:
-            if not self.connect():
-                return None
-        buf = self.camera.cache()
-        if view and buf is not None:
-            attributes = {
-                'localunit' : self.camera.pixel_unit,
-                   'camera' : self.camera.name,
-                    'pixel' : self.camera.pixel_size,
-                  'binning' : self.camera.binning,
-                 'exposure' : self.camera.exposure,
-             'acq_datetime' : datetime.now(),
-            }
-            frame = self.graph.load(buf, **attributes, **kwargs)
-            self.parent.handler('frame_cached', frame)
-        return buf
-    
-    def capture_ex(self):
-        """Capture image and load into the graph view."""
-        return self.capture(True)
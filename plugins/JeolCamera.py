@@ -1,10 +1,9 @@
 #! python3
 """Jeol Camera module.
 """
-from datetime import datetime
 import wx
 
-from wxpj import Layer, Param, LParam, Button, Choice
+from wxpj import CameraLayer, Param, LParam, Button, ToggleButton, Choice
 from pyJeol import Camera, DummyCamera
 
 
@@ -22,7 +21,7 @@ typenames_info = { # maxcnt,
 }
 
 
-class Plugin(Layer):
+class Plugin(CameraLayer):
     """Jeol camera manager.
     """
     menukey = "Cameras/&Jeol camera ver.2"
@@ -43,6 +42,8 @@ class Plugin(Layer):
         
         self.chk = wx.CheckBox(self, label="...")
         self.chk.SetToolTip("Use snapshot if cache is not supported.")
+        self.chk.Bind(wx.EVT_CHECKBOX, self.set_snapshot)
+        self.use_snapshot = False # (referred to from the acquisition thread)
         
         self.layout((
                 self.binning_selector,
@@ -53,6 +54,7 @@ class Plugin(Layer):
         )
         self.layout((
                 Button(self, "Capture", self.capture_ex, icon='camera'),
+                ToggleButton(self, "Prefetch", self.toggle_prefetch, icon='->'),
                 self.chk,
             ),
             row=2,
@@ -85,6 +87,9 @@ class Plugin(Layer):
         if self.camera:
             self.camera.gain = p.value
     
+    def set_snapshot(self, evt):
+        self.use_snapshot = evt.IsChecked()
+    
     def set_pixsize(self, p):
         if self.camera:
             self.camera.pixel_size = p.value
@@ -119,34 +124,9 @@ class Plugin(Layer):
             self.camera = None
             return None
     
-    def capture(self, view=False, **kwargs):
-        """Capture image.
-        
-        Args:
-            view    : If True, the buffer will be loaded into the graph view.
-            **kwargs: Additional attributes of the buffer frame.
-                      Used only if view is True.
-        """
-        if not self.camera:
-            if not self.connect():
-                return None
-        if not self.chk.Value:
-            buf = self.camera.cache()
+    def grab(self):
+        """Acquire an image synchronously (blocks for exposure and transfer)."""
+        if not self.use_snapshot:
+            return self.camera.cache()
         else:
-            buf = self.camera.snapshot()
-        if view and buf is not None:
-            attributes = {
-                'localunit' : self.camera.pixel_unit,
-                   'camera' : self.camera.name,
-                    'pixel' : self.camera.pixel_size,
-                  'binning' : self.camera.binning,
-                 'exposure' : self.camera.exposure,
-             'acq_datetime' : datetime.now(),
-            }
-            frame = self.graph.load(buf, **attributes, **kwargs)
-            self.parent.handler('frame_cached', frame)
-        return buf
-    
-    def capture_ex(self):
-        """Capture image and load into the graph view."""
-        return self.capture(True)
+            return self.camera.snapshot()
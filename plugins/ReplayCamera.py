@@ -0,0 +1,243 @@
+#! python3
+"""Replay camera module.
+
+Stored frames are streamed through the camera interface at the target fps,
+so that live workflows can be run and tuned offline (without TEM).
+"""
+import os
+import time
+import threading
+import wx
+import cv2
+import numpy as np
+
+from wxpj import CameraLayer, Param, LParam, Button, ToggleButton, Choice
+import editor as edi
+
+
+wildcards = [
+    "Image files (*.tif;*.dm3;*.dm4;*.img)|*.tif;*.dm3;*.dm4;*.img",
+    "Memory-mapped stack (*.npy)|*.npy",
+    "All files (*.*)|*.*",
+]
+
+
+class Camera(object):
+    """Replay camera (proxy of Detector).
+    
+    Args:
+        name       : camera name
+        source     : list of image files (.dm3/.dm4/.tif/.img),
+                     or a stack file (.npy) of shape (n, h, w) to memory-map.
+        pixel_size : pixel size [mm/pix]
+    
+    Attributes:
+        fps     : target frame rate [1/s]; 0 => exposure limits the rate.
+        noise   : Gaussian noise to inject [counts rms]
+        drift   : drift rate (vx, vy) to inject [pix/s]
+    """
+    @property
+    def pixel_unit(self):
+        return self.pixel_size * self.binning
+    
+    maxcache = 32 # maximum number of decoded files to keep
+    
+    def __init__(self, name, source, pixel_size=0.0050):
+        if isinstance(source, str):
+            source = [source]
+        self.paths = list(source)
+        self.stack = None
+        if len(self.paths) == 1 and self.paths[0].endswith('.npy'):
+            stack = np.load(self.paths[0], mmap_mode='r')
+            self.stack = stack.reshape((-1,) + stack.shape[-2:])
+        self._frames = {} # decoded files
+        
+        self.name = name
+        self.pixel_size = pixel_size
+        self.shape = self.read(0).shape[:2]
+        self.info = (pixel_size, *self.shape)
+        self.binning = 1
+        self.exposure = 0.1
+        self.fps = 10
+        self.noise = 0
+        self.drift = (0, 0)
+        self.index = 0
+        self._start_time = None
+        self._cached_time = 0
+        self._cached_image = None
+        self._lock = threading.Lock()
+        self._rng = np.random.default_rng()
+    
+    def __len__(self):
+        return len(self.stack) if self.stack is not None else len(self.paths)
+    
+    def read(self, i):
+        """Read the i-th stored frame."""
+        if self.stack is not None:
+            return self.stack[i]
+        buf = self._frames.get(i)
+        if buf is None:
+            buf, _info = edi.read_buffer(self.paths[i])
+            if buf.ndim > 2:
+                buf = buf.mean(axis=2) # RGB -> gray
+            if len(self._frames) < self.maxcache:
+                self._frames[i] = buf
+        return buf
+    
+    def reset(self):
+        """Rewind the stream and the injected drift."""
+        with self._lock:
+            self.index = 0
+            self._start_time = None
+    
+    def cache(self):
+        """Cache of the current image.
+        
+        Blocks until the next frame time at the target fps.
+        """
+        with self._lock:
+            dt = 1/self.fps if self.fps else self.exposure
+            wait = self._cached_time + dt - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            t = time.perf_counter()
+            if self._start_time is None:
+                self._start_time = t
+            
+            src = self.read(self.index % len(self))
+            self.index += 1
+            
+            dx, dy = np.multiply(self.drift, t - self._start_time)
+            bin = self.binning
+            if not (dx or dy or self.noise or bin > 1):
+                buf = np.array(src) # (from memmap)
+            else:
+                buf = src.astype(np.float32)
+                if dx or dy:
+                    M = np.float32([[1, 0, dx], [0, 1, dy]])
+                    h, w = buf.shape
+                    buf = cv2.warpAffine(buf, M, (w, h), borderMode=cv2.BORDER_REFLECT)
+                if bin > 1:
+                    h, w = buf.shape
+                    h, w = h//bin, w//bin
+                    buf = buf[:h*bin, :w*bin].reshape(h, bin, w, bin).sum(axis=(1,3))
+                if self.noise:
+                    buf += self._rng.normal(0, self.noise, buf.shape).astype(np.float32)
+            self._cached_image = buf
+            self._cached_time = t
+            return buf
+
+
+class Plugin(CameraLayer):
+    """Replay camera manager.
+    """
+    menukey = "Cameras/&Replay camera"
+    
+    def Init(self):
+        self.binning_selector = Param("bin", (1, 2, 4), 1, handler=self.set_binning)
+        self.exposure_selector = LParam("exp", (0, 5, 0.05), 0.05, handler=self.set_exposure)
+        self.fps_selector = LParam("fps", (0, 100, 1), 10, handler=self.set_stream)
+        self.noise_selector = LParam("noise", (0, 1000, 1), 0, handler=self.set_stream)
+        self.vx_selector = LParam("vx", (-10, 10, 0.01), 0, handler=self.set_stream)
+        self.vy_selector = LParam("vy", (-10, 10, 0.01), 0, handler=self.set_stream)
+        
+        self.name_selector = Choice(self,
+            choices=["Replay"], size=(100,22))
+        self.name_selector.value = "Replay"
+        
+        self.unit_selector = LParam("mm/pix", (0, 1, 1e-4), self.graph.unit,
+            handler=self.set_pixsize)
+        
+        self.layout((
+                self.binning_selector,
+                self.exposure_selector,
+            ),
+            title="Acquire setting", type='vspin', cw=-1, lw=32, tw=46,
+        )
+        self.layout((
+                self.fps_selector,
+                self.noise_selector,
+                self.vx_selector,
+                self.vy_selector,
+            ),
+            title="Stream [counts, pix/s]", type='vspin', cw=-1, lw=32, tw=46,
+        )
+        self.layout((
+                Button(self, "Capture", self.capture_ex, icon='camera'),
+                ToggleButton(self, "Prefetch", self.toggle_prefetch, icon='->'),
+            ),
+            row=2,
+        )
+        self.layout((
+                self.name_selector,
+                self.unit_selector,
+                Button(self, "Open", self.open, size=(-1,20)),
+                Button(self, "Rewind", self.rewind, size=(-1,20)),
+            ),
+            title="Setup", show=0, type=None, lw=-1, tw=50,
+        )
+        self.paths = []
+        self.camera = None
+    
+    ## --------------------------------
+    ## Camera Attributes
+    ## --------------------------------
+    
+    def set_exposure(self, p):
+        if p.value < 0.01:
+            p.value = 0.01
+        if self.camera:
+            self.camera.exposure = p.value
+    
+    def set_binning(self, p):
+        if self.camera:
+            self.camera.binning = p.value
+    
+    def set_pixsize(self, p):
+        if self.camera:
+            self.camera.pixel_size = p.value
+    
+    def set_stream(self, p):
+        if self.camera:
+            self.camera.fps = self.fps_selector.value
+            self.camera.noise = self.noise_selector.value
+            self.camera.drift = (self.vx_selector.value, self.vy_selector.value)
+    
+    def open(self):
+        """Open the image files (or a stack) to replay and connect."""
+        with wx.FileDialog(self, "Open frames to replay",
+                wildcard='|'.join(wildcards),
+                style=wx.FD_OPEN|wx.FD_MULTIPLE|wx.FD_FILE_MUST_EXIST) as dlg:
+            if dlg.ShowModal() != wx.ID_OK:
+                return None
+            self.paths = sorted(dlg.Paths)
+        return self.connect()
+    
+    def rewind(self):
+        """Rewind the replay stream to the first frame."""
+        if self.camera:
+            self.camera.reset()
+    
+    def connect(self):
+        name = self.name_selector.value
+        if not self.paths:
+            self.message("- No frames to replay. Open the files first.")
+            return None
+        try:
+            self.message(f"Connecting to {name}...")
+            self.camera = Camera(name, self.paths, self.unit_selector.value)
+            
+            self.message("Connected to", self.camera)
+            self.message("\b {} frames from {!r}".format(len(self.camera),
+                         os.path.dirname(self.paths[0])))
+            
+            ## <--- set camera parameter
+            self.camera.binning = self.binning_selector.value
+            self.camera.exposure = self.exposure_selector.value
+            self.set_stream(None)
+            return self.camera
+        
+        except Exception as e:
+            self.message("- Connection failed:", e)
+            self.camera = None
+            return None
@@ -1,9 +1,8 @@
 #! python3
 """Rigaku camera module.
 """
-from datetime import datetime
 
-from wxpj import Layer, Param, LParam, Button, Choice
+from wxpj import CameraLayer, Param, LParam, Button, ToggleButton, Choice
 from pyRigaku import Camera
 
 
@@ -17,7 +16,7 @@ typenames_info = { # pixel_size, h, w, ...
 }
 
 
-class Plugin(Layer):
+class Plugin(CameraLayer):
     """Rigaku camera manager.
     """
     menukey = "Cameras/&Rigaku camera ver.2"
@@ -42,6 +41,7 @@ class Plugin(Layer):
         )
         self.layout((
                 Button(self, "Capture", self.capture_ex, icon='camera'),
+                ToggleButton(self, "Prefetch", self.toggle_prefetch, icon='->'),
             ),
             row=2,
         )
@@ -99,32 +99,3 @@ class Plugin(Layer):
             self.message("- Connection failed:", e)
             self.camera = None
             return None
-    
-    def capture(self, view=False, **kwargs):
-        """Capture image.
-        
-        Args:
-            view    : If True, the buffer will be loaded into the graph view.
-            **kwargs: Additional attributes of the buffer frame.
-                      Used only if view is True.
-        """
-        if not self.camera:
-            if not self.connect():
-                return None
-        buf = self.camera.cache()
-        if view and buf is not None:
-            attributes = {
-                'localunit' : self.camera.pixel_unit,
-                   'camera' : self.camera.name,
-                    'pixel' : self.camera.pixel_size,
-                  'binning' : self.camera.binning,
-                 'exposure' : self.camera.exposure,
-             'acq_datetime' : datetime.now(),
-            }
-            frame = self.graph.load(buf, **attributes, **kwargs)
-            self.parent.handler('frame_cached', frame)
-        return buf
-    
-    def capture_ex(self):
-        """Capture image and load into the graph view."""
-        return self.capture(True)
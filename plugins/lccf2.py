@@ -1,29 +1,78 @@
 #! python3
+from concurrent.futures import ThreadPoolExecutor
+import os
 import cv2
 import numpy as np
-from numpy import pi,cos,sin
-from matplotlib import patches
+from matplotlib.collections import EllipseCollection
+from matplotlib.transforms import IdentityTransform
 
 from wxpj import Layer, LParam, Button
 import editor as edi
 
 
-def find_ellipses(src, rmin):
-    ## Find contours in binary image
-    ## ▲ src 第一引数は上書きされるので後で参照するときは注意する
-    argv = cv2.findContours(src, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+def _fit_ellipses(src, lo, hi, y0, y1):
+    """Fit ellipses to the contours in the strip src[lo:hi].
+    
+    Only the ellipses centered in the core rows [y0:y1] are returned.
+    The contours touching the cut edges of the strip are excluded.
+    """
+    h = src.shape[0]
+    buf = src[lo:hi].copy() # (findContours may overwrite)
+    argv = cv2.findContours(buf, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     try:
         contours, hierarchy = argv
     except ValueError:
         _c, contours, hierarchy = argv # opencv <= 3.4.5
     
-    ## Detect enclosing rectangles
+    ellipses = []
+    for v in contours:
+        if len(v) < 5: # At least 5 points are needed to fit an ellipse.
+            continue
+        y = v[:,0,1]
+        if (lo > 0 and y.min() == 0) or (hi < h and y.max() == hi-lo-1):
+            continue
+        (cx, cy), r, a = cv2.fitEllipse(v)
+        cy += lo
+        if y0 <= cy < y1:
+            ellipses.append(((cx, cy), r, a))
+    return ellipses
+
+
+def find_ellipses(src, rmin, tiles=None):
+    """Find ellipses in the binary image.
+    
+    The image is split into horizontal strips (overlapping with margins)
+    that are processed in a thread pool (OpenCV releases the GIL).
+    
+    Args:
+        src     : binary image <uint8>
+        rmin    : minimum width of the ellipses [pix]
+        tiles   : number of strips
+                  If None, the number of cpus, but a single pass is used
+                  on small images (h < 2048) or machines with less than 3 cpus,
+                  where the overhead of tiling exceeds the gain.
+    
+    Returns:
+        RotatedRect: (cx,cy), (ra,rb), angle sorted by the distance from the center.
+    """
+    h, w = src.shape
+    if tiles is None:
+        tiles = os.cpu_count() or 1
+        if tiles < 3 or h < 2048:
+            tiles = 1
+    n = min(tiles, max(1, h // 256))
+    if n > 1:
+        step = -(-h // n)
+        m = max(64, step // 2) # margin for the ellipses on the cut edges
+        args = [(src, max(0, y-m), min(h, y+step+m), y, y+step) for y in range(0, h, step)]
+        with ThreadPoolExecutor(n) as executor:
+            ellipses = [v for ls in executor.map(lambda v: _fit_ellipses(*v), args) for v in ls]
+    else:
+        ellipses = _fit_ellipses(src, 0, h, 0, h)
+    
     ## Note:
-    ##     At least 5 points are needed to fit an ellipse.
     ##     NaN should be eliminated.
-    ellipses = [cv2.fitEllipse(v) for v in contours if len(v) > 4]
     ellipses = filter(lambda v: not np.any(np.isnan(v[0:2])), ellipses)
-    h, w = src.shape
     
     def _inside(v, tol=0.75/2): # 画像の端にある円を除く
         c, r, a = v
@@ -52,7 +101,7 @@ class Plugin(Layer):
         )
         self.layout((btn,))
     
-    maxcount = 256 # 選択する点の数を制限する
+    maxcount = None # 選択する点の数を制限する (None: no limit)
     maxratio = 5.0 # ひずみの大きい楕円は除外する
     
     def execute(self, frame=None, otsu=True):
@@ -81,64 +130,68 @@ class Plugin(Layer):
             self.message(f"\b Adjust lccf/rmin to optimize detection.")
             return
         N = self.maxcount
-        if n > N:
+        if N and n > N:
             self.message(f"Too many circles found. Limiting number to {N}.")
             circles = circles[:N]
         
-        xy = []
-        for (cx, cy), (ra, rb), angle in circles:
-            if ra and rb/ra < self.maxratio:
-                ## 不特定多数の円を描画する
-                art = patches.Circle((0, 0), 0, color='r', ls='dotted', lw=1, fill=0)
-                art.center = frame.xyfrompixel(cx, cy)
-                art.height = ra * frame.unit
-                art.width = rb * frame.unit
-                art.angle = 90-angle
-                self.attach_artists(frame.axes, art)
-                
-                ## 検出した楕円の中心をそのまま記録する
-                ## 強度の偏りが出ないように，十分ぼかし幅をとること
-                xy.append(art.center)
-                
-                ## r = int(np.hypot(ra, rb) / 2) # max radius enclosing the area rectangle
-                ## x, y = int(cx), int(cy)
-                ## buf = frame.buffer[y-r:y+r+1, x-r:x+r+1]
-                ## img = frame.image[y-r:y+r+1, x-r:x+r+1]
-                
-                ## local maximum that is found first in the region. ▲偏りが出るので NG
-                ## dy, dx = np.unravel_index(buf.argmax(), buf.shape)
-                
-                ## local maximum :averaged (強度の偏りを考慮する) ▲偏りが出るので NG
-                ## yy, xx = np.where(buf == np.amax(buf))
-                ## dy, dx = np.average(yy), np.average(xx)
-                
-                ## centroid of masked array
-                ## buf = np.ma.masked_array(img, mask_ellipse(r, ra, rb, angle))
-                ## dx, dy = centroid(buf)
-                ## x, y = frame.xyfrompixel(x-r+dx, y-r+dy)
-                ## xy.append((x, y))
-        if xy:
-            frame.markers = np.array(xy).T # scatter markers if any xy
+        cx, cy, ra, rb, angle = np.array([(*c, *r, a) for c, r, a in circles]).T
+        ok = (ra > 0) & (rb < self.maxratio * ra)
+        if not ok.any():
+            return
+        cx, cy, ra, rb, angle = cx[ok], cy[ok], ra[ok], rb[ok], angle[ok]
+        
+        ## 楕円の中心を含むスポットの強度重心を記録する
+        ## (スポット外にある場合は楕円の中心をそのまま記録する)
+        labels, mx, my = spot_centroids(frame.buffer, buf)
+        h, w = labels.shape
+        j = labels[np.clip(np.int_(np.round(cy)), 0, h-1),
+                   np.clip(np.int_(np.round(cx)), 0, w-1)]
+        xy = frame.xyfrompixel(np.where(j, mx[j], cx), np.where(j, my[j], cy))
+        
+        ## 不特定多数の円を描画する (一つのコレクションにまとめる)
+        art = EllipseCollection(rb * frame.unit, ra * frame.unit, 90-angle,
+                                units='xy', offsets=xy.T,
+                                offset_transform=frame.axes.transData,
+                                transform=IdentityTransform(),
+                                facecolors='none', edgecolors='r',
+                                linestyles='dotted', linewidths=1)
+        self.attach_artists(frame.axes, art)
+        
+        ## マーカー数の上限 (GraphPlot.maxnum_markers) を全点が入るように広げる
+        view = frame.parent
+        if xy.shape[1] > view.maxnum_markers:
+            view.maxnum_markers = xy.shape[1]
+        frame.markers = xy # scatter markers
 
 
-def centroid(src):
-    """centroids (重心).
-    cf. ndi.measurements.center_of_mass
+def spot_centroids(src, mask):
+    """Intensity-weighted centroids of the spots (重心).
+    
+    The spots are the connected components of the binary mask, and
+    the moments of all spots are evaluated at once (no loop over spots).
+    The minimum intensity of each spot is subtracted as its background.
+    
+    Returns:
+        labels  : label image <int32> (0: background)
+        cx, cy  : sub-pixel centroids of the labels [pix]
+                  (index 0 is the background)
     """
-    ## Note:
-    ##     moments は findContours と組み合わせても使用される．
-    ##     src <int32/float32> はコンター座標とみなされる．
-    buf = edi.imconv(src)
-    M = cv2.moments(buf)
-    cx = M['m10']/M['m00']
-    cy = M['m01']/M['m00']
-    return cx, cy
-
-
-def mask_ellipse(r, ra, rb, angle):
-    y, x = np.ogrid[-r:r+1, -r:r+1]
-    yo, xo = 0, 0
-    t = angle * pi/180
-    xx = (x-xo) * cos(t) + (y-yo) * sin(t)
-    yy = (x-xo) *-sin(t) + (y-yo) * cos(t)
-    return np.hypot(xx/ra*2, yy/rb*2) > 1 # 楕円の短径 ra/2 < 長径 rb/2
+    n, labels, stats, centers = cv2.connectedComponentsWithStats(
+        mask, connectivity=8, ltype=cv2.CV_32S)
+    if src.ndim > 2:
+        src = src.mean(axis=2) # rgb2gray
+    ys, xs = np.nonzero(labels)
+    lb = labels[ys, xs]
+    v = src[ys, xs].astype(np.float64)
+    vmin = np.full(n, np.inf)
+    np.minimum.at(vmin, lb, v)
+    v -= vmin[lb]
+    
+    m00 = np.bincount(lb, v, minlength=n)
+    m10 = np.bincount(lb, v * xs, minlength=n)
+    m01 = np.bincount(lb, v * ys, minlength=n)
+    ok = m00 > 0
+    cx, cy = centers.T.copy() # geometric centers for flat spots
+    cx[ok] = m10[ok] / m00[ok]
+    cy[ok] = m01[ok] / m00[ok]
+    return labels, cx, cy
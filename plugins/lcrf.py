@@ -5,6 +5,7 @@ import numpy as np
 from numpy import pi
 from scipy import optimize
 from scipy import signal
+from scipy.fft import next_fast_len
 from matplotlib import pyplot as plt
 from matplotlib import patches
 
@@ -15,10 +16,12 @@ import editor as edi
 class Model(object):
     """Cor-fitting model function.
     """
-    def __init__(self, x, y):
+    def __init__(self, x, y, report=None):
         params = [0.,] * 5
         x = np.array(x)
         y = np.array(y)
+        self.report = report # progress hook (cf. editor.FitReport)
+        self._cache = {}
         result = optimize.leastsq(self.residual, params, args=(x,y))
         self.params = result[0]
     
@@ -29,40 +32,115 @@ class Model(object):
     def residual(self, params, x, y):
         self.params = params
         res = (self(x) - y)**2
-        print("\b"*72 + "point({}): residual {:g}".format(len(res), sum(res)), end=' ')
+        if self.report is not None:
+            self.report(res)
         return res
     
-    def mod2d(self, buf):
+    def shifts(self, h, subpix=False):
+        """Radial-shift vectors of h rows (cached per (h, params)).
+        
+        Returns:
+            s : integer part of shifts
+            f : fractional part of shifts (zeros unless subpix)
+        """
+        key = ('shifts', h, tuple(self.params), subpix)
+        if key not in self._cache:
+            v = self(np.arange(h)/h * 2*pi)[::-1] # radial-shift vectors
+            s = np.floor(v) if subpix else np.trunc(v)
+            self._cache[key] = (s.astype(int), v - s)
+        return self._cache[key]
+    
+    def index_map(self, shape, subpix=False):
+        """Gather index map of the shifted rows (cached per (shape, params)).
+        """
+        key = ('index', shape, tuple(self.params), subpix)
+        if key not in self._cache:
+            h, w = shape
+            s, f = self.shifts(h, subpix)
+            self._cache[key] = (np.arange(w) + s[:,None]) % w
+        return self._cache[key]
+    
+    def mod2d(self, buf, subpix=False):
         """Calculate modulated image.
         
         Args:
-            buf : polar-transformed output buffer
+            buf     : polar-transformed output buffer
+            subpix  : shift rows in sub-pixel (linear interpolation)
         
         Returns:
             2D-array of modulated image
         """
         h, w = buf.shape
-        rsv = [self(x) for x in np.arange(0,h)/h * 2*pi][::-1] # radial-shift vectors
-        data = np.resize(0., (h, w))
-        for j, (x, v) in enumerate(zip(buf, rsv)):
-            data[j] = np.roll(x, -int(v))
+        idx = self.index_map(buf.shape, subpix)
+        data = np.take_along_axis(buf, idx, axis=1)
+        if subpix:
+            s, f = self.shifts(h, subpix)
+            f = f[:,None]
+            data = data * (1-f) + np.take_along_axis(buf, (idx + 1) % w, axis=1) * f
         return data
     
-    def mod1d(self, buf):
+    def mod1d(self, buf, subpix=False):
         """Calculate line profile averaged with modulation correction.
         
         Args:
-            buf : polar-transformed output buffer
+            buf     : polar-transformed output buffer
+            subpix  : shift rows in sub-pixel (linear interpolation)
         
         Returns:
             1D-array of modulated (+avr.) line profile
+        
+        Note:
+            The rows having the same shift are summed up first,
+            so the modulated 2D image is not materialised.
         """
         h, w = buf.shape
-        data = sum(self.mod2d(buf))
+        s, f = self.shifts(h, subpix)
+        rows = np.arange(h)
+        wt = np.ones(h)
+        if subpix:
+            s = np.append(s, s+1)
+            wt = np.append(1-f, f)
+            rows = np.append(rows, rows)
+        u, inv = np.unique(s, return_inverse=True)
+        W = np.zeros((len(u), h), dtype=np.result_type(buf.dtype, np.float32))
+        np.add.at(W, (inv.ravel(), rows), wt)
+        A = W @ buf # sum of rows for each shift
+        idx = (np.arange(w) + u[:,None]) % w
+        data = np.take_along_axis(A, idx, axis=1).sum(axis=0)
         return data / h
 
 
-def find_ring_center(src, center, lo, hi, N=256, tol=0.01):
+def correlate_rows(buf, subpix=False):
+    """Correlate each row of buf with the first row (template at theta = 0).
+    
+    The rows are correlated at once using real FFTs along the row axis
+    (editor.fft_service), which is equivalent to `signal.fftconvolve(row, buf[0][::-1], mode='same')`.
+    
+    Args:
+        buf     : 2D-array of polar-transformed rows
+        subpix  : Refine the peak positions in sub-pixel (parabolic fit).
+    
+    Returns:
+        1D-array of the correlation peak positions [pixels] for each row
+    """
+    h, w = buf.shape
+    n = next_fast_len(2*w - 1, real=True)
+    fft = edi.fft_service
+    F = fft.rfftn(buf, (n,), axes=(1,), copy=False) * fft.rfftn(buf[0][::-1], (n,))
+    j = (w-1)//2 # start of the 'same' mode
+    corr = fft.irfftn(F, (n,), axes=(1,))[:, j:j+w]
+    peaks = corr.argmax(axis=1)
+    if not subpix:
+        return peaks
+    i = np.arange(h)
+    k = np.clip(peaks, 1, w-2) # 端であれば内側にずらしておく
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dx, _dy, convex, inside = edi._qrsp([-1,0,1],
+                                            (corr[i,k-1], corr[i,k], corr[i,k+1]))
+    return np.where(convex & inside, k + dx, peaks)
+
+
+def find_ring_center(src, center, lo, hi, N=256, tol=0.01, subpix=False):
     """Find center of ring pattern in buffer.
     
     極座標変換した後，角度セグメントに分割して相互相関をとる．
@@ -75,6 +153,7 @@ def find_ring_center(src, center, lo, hi, N=256, tol=0.01):
         lo-hi   : masking size of radial axis
         N       : resizing of angular axis (total step in angle [0:2pi])
         tol     : remove peaks that leap greater than N * tol
+        subpix  : Evaluate the relative displacements in sub-pixel.
     
     Returns:
         dst(linear-polar-transformed image), guessed center, and fitting model
@@ -99,15 +178,12 @@ def find_ring_center(src, center, lo, hi, N=256, tol=0.01):
     s = np.std(rdst)
     rdst[(rdst < -5*s) | (rdst > 5*s)] = 0
     
-    temp = rdst[0][::-1] # template of corr; distr at theta = 0
-    data = []
-    for fr in rdst:
-        p = signal.fftconvolve(fr, temp, mode='same')
-        data.append(p.argmax())
+    ## template of corr; distr at theta = 0
+    data = correlate_rows(rdst, subpix)
     
     ## 相関の計算は上から行うので，2pi --> 0 の並びになる
     ## 最終的に返す計算結果は逆転させて，0 --> 2pi の並びにする
-    Y = np.array(data[::-1]) - (hi-lo)/2
+    Y = data[::-1] - (hi-lo)/2
     X = np.arange(0, 1, 1/len(Y)) * 2*pi
     
     ## remove leaps(2): tol より小さいとびを許容する (画素サイズに比例)
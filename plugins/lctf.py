@@ -2,43 +2,72 @@
 import cv2
 import numpy as np
 from numpy import pi
-from numpy.fft import fft,ifft,fft2,ifft2,fftshift,fftfreq
+from scipy.fft import fft2, fftshift
 from scipy import signal
 from matplotlib import pyplot as plt
 from matplotlib import patches
 
-from wxpj import Layer, LParam
+from wxpj import Layer, Param, LParam
 import editor as edi
 
-from lcrf import Model
+from lcrf import Model, correlate_rows
 
 
-def logpolar(src, r0, r1, center=None):
-    """Log-Polar transform.
-    The area radii [r0:r1] of radius N/2 mapsto the same size of src image.
+def logpolar_maps(shape, r0, r1, center=None, N=None):
+    """Remap arrays (map_x, map_y) of the log-polar transform.
     
-    cf. cv2.logPolar(src, (nx,ny), M, cv2.INTER_CUBIC)
+    The maps are cached in `logpolar_maps.cache` (LRU with memory limit)
+    keyed by (shape, r0, r1, center, N), where the radii are rounded to 1/100 pixel
+    so that the same slider ratios hit the cache.
+    
+    Args:
+        shape   : shape (h, w) of the src image
+        r0-r1   : radii of the area to transform
+        center  : center position (xc, yc); defaults to the image center
+        N       : number of angular rows; defaults to h
     """
-    h, w = src.shape
+    h, w = shape
     if center is None:
-        xc, yc = w//2, h//2
-    else:
+        center = (w//2, h//2)
+    if N is None:
+        N = h
+    r0 = round(float(r0), 2)
+    r1 = round(float(r1), 2)
+    
+    def _make_maps():
         xc, yc = center
+        x = np.arange(w, dtype=np.float32) /w
+        y = np.arange(N, dtype=np.float32) * 2*pi /N
+        
+        rh0 = np.log(r0) if r0>0 else 0
+        rh1 = np.log(r1)
+        r = np.exp(rh0 + (rh1 - rh0) * x) # radial axis (1D)
+        map_x = (xc + r * np.cos(y)[:,None]).astype(np.float32)
+        map_y = (yc + r * np.sin(y)[:,None]).astype(np.float32)
+        return map_x, map_y
     
-    x = np.arange(w, dtype=np.float32) /w
-    y = np.arange(h, dtype=np.float32) * 2*pi /h
-    xx, yy = np.meshgrid(x, y)
+    key = ((h, w), r0, r1, tuple(center), N)
+    return logpolar_maps.cache.get(key, _make_maps)
+
+logpolar_maps.cache = edi.LRUCache(256e6)
+
+
+def logpolar(src, r0, r1, center=None, N=None):
+    """Log-Polar transform.
+    The area radii [r0:r1] of radius N/2 mapsto the same size of src image.
     
-    rh0 = np.log(r0) if r0>0 else 0
-    rh1 = np.log(r1)
-    r = np.exp(rh0 + (rh1 - rh0) * xx)
-    map_x = (xc + r * np.cos(yy)).astype(np.float32)
-    map_y = (yc + r * np.sin(yy)).astype(np.float32)
+    Args:
+        N : number of angular rows (reduced-angular-resolution mode).
+            If None, the output has the same size as the src image.
+    
+    cf. cv2.logPolar(src, (nx,ny), M, cv2.INTER_CUBIC)
+    """
+    map_x, map_y = logpolar_maps(src.shape, r0, r1, center, N)
     dst = cv2.remap(src, map_x, map_y, cv2.INTER_CUBIC)
     return dst
 
 
-def find_ring_center(src, lo, hi, N=256, tol=0.01):
+def find_ring_center(src, lo, hi, N=256, tol=0.01, subpix=False):
     """Find ring pattern in src image with fixed center.
     
     Polar 変換した後，角度セグメントに分割して相互相関をとる．
@@ -50,29 +79,25 @@ def find_ring_center(src, lo, hi, N=256, tol=0.01):
         lo-hi   : masking size of radial axis
         N       : resizing of angular axis (total step in angle [0:2pi])
         tol     : remove peaks that leap greater than N * tol
+        subpix  : Evaluate the relative displacements in sub-pixel.
     
     Returns:
-        dst(log-polar-transformed image) and fitting model
+        fitting model
     """
     h, w = src.shape
     
-    dst = logpolar(src, lo, hi)
-    
-    ## Resize Y (angular) axis (計算を軽くするためリサイズ)
-    rdst = cv2.resize(dst.astype(np.float32), (w, N), interpolation=cv2.INTER_AREA)
+    ## Remap to N rows of angle directly (計算を軽くするため角度方向を縮小)
+    rdst = logpolar(src, lo, hi, N=N).astype(np.float32)
     
     rdst -= rdst.mean()
     rdst = cv2.GaussianBlur(rdst, (1,11), 0)
     
-    temp = rdst[0][::-1] # template of corr; distr at theta=0(=2pi)
-    data = []
-    for fr in rdst:
-        p = signal.fftconvolve(fr, temp, mode='same')
-        data.append(p.argmax())
+    ## template of corr; distr at theta=0(=2pi)
+    data = correlate_rows(rdst, subpix)
     
     ## 相関の計算は上から行うので，2pi --> 0 の並びのリストになる
     ##   最終的に返す計算結果は逆転させて，0 --> 2pi の並びにする
-    Y = np.array(data[::-1]) - w/2
+    Y = data[::-1] - w/2
     X = np.arange(0, 1, 1/len(Y)) * 2*pi
     
     ## remove leaps(2): tol より小さいとびを許容する (画素サイズに比例)
@@ -93,7 +118,7 @@ def find_ring_center(src, lo, hi, N=256, tol=0.01):
     fitting_curve.params[1] = 0
     fitting_curve.params[2] = 0
     
-    return dst, fitting_curve
+    return fitting_curve
 
 
 def smooth1d(data, tol=0.01):
@@ -149,6 +174,141 @@ def find_radial_peaks(data, tol=0.01):
     return ys, maxima, minima # np.sort(np.append(maxima, minima))
 
 
+def eval_ring(src, rmin, rmax, N=256, tol=0.05, tile=0):
+    """Evaluate log-polar of ring pattern.
+    
+    Args:
+        src     : source buffer (typ. fftcrop-ed ROI)
+        rmin    : ratio of the minimum radius to the width
+        rmax    : ratio of the maximum radius to the width
+        tile    : tile size of the periodogram-averaged spectrum.
+                  If 0, the spectrum is taken by a single FFT of src.
+    
+    Returns:
+        dst     : log-polar-transformed image
+        axis    : radial axis [R0:R1] <= [0:1/2]
+        data    : line profile averaged with modulation correction
+        fitting_curve : fitting model of the ring modulation
+        stig    : astigmatism (complex)
+    """
+    if tile:
+        buf = edi.welch_spectrum(src, tile)
+        buf = np.log(1 + np.sqrt(buf))
+    else:
+        buf = np.log(1 + edi.fft_spectrum(src))
+    buf -= buf.mean()
+    h, w = buf.shape
+    
+    r0 = w * rmin
+    r1 = w * rmax
+    fitting_curve = find_ring_center(buf, r0, r1, N=N, tol=tol)
+    dst = logpolar(buf, r0, r1) # full size for the modulation correction
+    
+    m = w / np.log(r1/r0)
+    
+    axis = r0 / w * np.exp(np.arange(w) / m) # [R0:R1] <= [0:1/2]
+    data = fitting_curve.mod1d(dst)
+    
+    ## 拡張 log-polar 変換は振幅が m 倍だけ引き延ばされている
+    eps, phi = fitting_curve.params[3:5]
+    stig = eps / m * np.exp(phi * 1j)
+    return dst, axis, data, fitting_curve, stig
+
+
+def eval_peak(axis, data, rmin, rmax, tol):
+    """Evaluate min/max peaks of the ring profile.
+    
+    Args:
+        axis    : radial axis (cf. eval_ring)
+        data    : line profile (cf. eval_ring)
+        rmin    : ratio of the minimum radius to the width
+        rmax    : ratio of the maximum radius to the width
+        tol     : ratio of blur pixels to the radius
+    
+    Returns:
+        newaxis : r^2 axis interpolated at regular intervals
+        newdata : smoothed profile along newaxis
+        lxy     : low peaks (x, y)
+        hxy     : high peaks (x, y)
+        lpoints : filtered low peaks (x, y) used for fitting
+    """
+    N = data.size
+    R0 = rmin
+    R1 = rmax
+    
+    ## r2:data の一定間隔補間データを作ってゼロ点を求める
+    newaxis = np.linspace(R0**2, R1**2, N)
+    orgdata = np.interp(newaxis, axis**2, data)
+    newdata = smooth1d(orgdata, tol)
+    
+    newdata, maxima, minima = find_radial_peaks(newdata, tol)
+    
+    ## Check validity of zero-points spacing
+    hx, hy = newaxis[maxima], newdata[maxima]
+    lx, ly = newaxis[minima], newdata[minima]
+    
+    ## --------------------------------
+    ## filter low peaks
+    ## --------------------------------
+    threshold = tol/10 * R1**2
+    lxx = []
+    lyy = []
+    for i, (x, y) in enumerate(zip(lx, ly)):
+        ## Eliminate if near one of high peaks
+        if min(abs(x - hx)) < threshold:
+            continue
+        ## Stop if two low pakes are continuous
+        ## if i < len(lx)-1:
+        ##     if not np.any((x < hx) & (hx < lx[i+1])):
+        ##         break
+        if i > 50:
+            break
+        lxx.append(x)
+        lyy.append(y)
+    lp = np.vstack((lxx, lyy))
+    
+    return newaxis, newdata, np.vstack((lx, ly)), np.vstack((hx, hy)), lp[:,:20] # max N low peaks
+
+
+class Result(object):
+    """Result of the CTF analysis stages.
+    
+    Each stage returns a new result with its own values added,
+    so that the results can be passed safely between threads/processes.
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+    
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, ', '.join(self.__dict__))
+    
+    def updated(self, **kwargs):
+        return self.__class__(**dict(self.__dict__, **kwargs))
+
+
+def ring_stage(src, rmin, rmax, N=256, tile=0):
+    """Stage 1: log-polar of ring pattern (cf. eval_ring).
+    
+    Returns:
+        Result(rmin, rmax, dst, axis, data, fitting_curve, stig)
+    """
+    dst, axis, data, fitting_curve, stig = eval_ring(src, rmin, rmax, N, tile=tile)
+    return Result(rmin=rmin, rmax=rmax, dst=dst, axis=axis, data=data,
+                  fitting_curve=fitting_curve, stig=stig)
+
+
+def peak_stage(res, tol):
+    """Stage 2: min/max peak detection (cf. eval_peak).
+    
+    Returns:
+        Result(..., tol, newaxis, newdata, lxy, hxy, lpoints)
+    """
+    newaxis, newdata, lxy, hxy, lpoints = eval_peak(res.axis, res.data,
+                                                    res.rmin, res.rmax, tol)
+    return res.updated(tol=tol, newaxis=newaxis, newdata=newdata,
+                       lxy=lxy, hxy=hxy, lpoints=lpoints)
+
+
 class Plugin(Layer):
     """CTF finder ver 1.0
     """
@@ -158,17 +318,18 @@ class Plugin(Layer):
         self.rmin = LParam("rmin", (0.001, 0.1, 0.001), 0.05, updater=self.calc_ring)
         self.rmax = LParam("rmax", (0.1, 0.5, 0.01), 0.5, updater=self.calc_ring)
         self.tol = LParam("tol", (0, 0.1, 0.001), 0.01, updater=self.calc_peak)
+        self.tile = Param("tile", (0, 256, 512, 1024, 2048), 0)
         
         self.layout((
                 self.rmin,
                 self.rmax,
                 self.tol,
+                self.tile,
             ),
             title="FFT Cond.",
             type='vspin', style='button', cw=-1, lw=28, tw=50,
         )
-        self.axis = None
-        self.data = None
+        self.result = None
     
     @property
     def selected_frame(self):
@@ -176,6 +337,8 @@ class Plugin(Layer):
     
     @property
     def selected_roi(self):
+        if self.tile.value: # periodogram-averaged spectrum of the whole ROI
+            return self.selected_frame.roi
         return edi.fftcrop(self.selected_frame.roi)
     
     def calc_ring(self, show=True):
@@ -185,31 +348,18 @@ class Plugin(Layer):
         """
         ## frame = self.selected_frame
         src = self.selected_roi
-        h, w = src.shape
-        
-        buf = fftshift(fft2(src))
-        buf = np.log(1 + abs(buf))
-        buf -= buf.mean()
         
         self.message("Calculating CTF ring...")
-        r0 = w * self.rmin.value
-        r1 = w * self.rmax.value
-        dst, self.fitting_curve = find_ring_center(buf, r0, r1, N=256, tol=0.05)
-        
-        m = w / np.log(r1/r0)
-        
-        self.axis = r0 / w * np.exp(np.arange(w) / m) # [R0:R1] <= [0:1/2]
-        self.data = self.fitting_curve.mod1d(dst)
+        res = ring_stage(src, self.rmin.value, self.rmax.value, tile=self.tile.value)
+        self.result = res
         
         if show:
             self.message("\b Loading log-polar image...")
-            dst = self.fitting_curve.mod2d(dst)
+            dst = res.fitting_curve.mod2d(res.dst)
             self.output.load(dst, "*log-polar*", pos=0)
         self.message("\b done.")
         
-        ## 拡張 log-polar 変換は振幅が m 倍だけ引き延ばされている
-        eps, phi = self.fitting_curve.params[3:5]
-        self.stig = eps / m * np.exp(phi * 1j)
+        eps, phi = res.fitting_curve.params[3:5]
         print("$result(eps, phi) = {!r}".format((eps, phi)))
     
     def calc_peak(self, show=True):
@@ -217,58 +367,29 @@ class Plugin(Layer):
         
         Referenced tol is the ratio of blur pixels to the radius.
         """
-        if self.data is None:
+        if self.result is None:
             self.message("- no data.")
             return
         
-        N = self.data.size
-        R0 = self.rmin.value
-        R1 = self.rmax.value
         tol = self.tol.value
+        res = peak_stage(self.result, tol)
+        self.result = res
+        
+        N = res.data.size
+        R1 = res.rmax
+        newaxis = res.newaxis
+        newdata = res.newdata
         
-        ## r2:data の一定間隔補間データを作ってゼロ点を求める
-        newaxis = np.linspace(R0**2, R1**2, N)
-        orgdata = np.interp(newaxis, self.axis**2, self.data)
-        newdata = smooth1d(orgdata, tol)
         if show:
-            plt.plot(newaxis, newdata, '--', lw=1) # original smoothing data
+            orgdata = np.interp(newaxis, res.axis**2, res.data)
+            plt.plot(newaxis, smooth1d(orgdata, tol), '--', lw=1) # original smoothing data
             plt.grid(True)
             plt.show()
         
-        newdata, maxima, minima = find_radial_peaks(newdata, tol)
-        
-        ## Check validity of zero-points spacing
-        hx, hy = newaxis[maxima], newdata[maxima]
-        lx, ly = newaxis[minima], newdata[minima]
-        
-        self.lxy = np.vstack((lx, ly))
-        self.hxy = np.vstack((hx, hy))
-        ## lp = np.vstack((lx, ly))
-        
-        ## --------------------------------
-        ## filter low peaks
-        ## --------------------------------
-        threshold = tol/10 * R1**2
-        print("$(threshold) = {!r}".format((threshold)))
-        lxx = []
-        lyy = []
-        for i, (x, y) in enumerate(zip(lx, ly)):
-            ## Eliminate if near one of high peaks
-            if min(abs(x - hx)) < threshold:
-                continue
-            ## Stop if two low pakes are continuous
-            ## if i < len(lx)-1:
-            ##     if not np.any((x < hx) & (hx < lx[i+1])):
-            ##         break
-            if i > 50:
-                break
-            lxx.append(x)
-            lyy.append(y)
-        lp = np.vstack((lxx, lyy))
-        
-        self.lpoints = lp[:,:20] # max N low peaks
-        self.newaxis = newaxis
-        self.newdata = newdata
+        lx, ly = res.lxy
+        hx, hy = res.hxy
+        lp = res.lpoints
+        print("$(threshold) = {!r}".format((tol/10 * R1**2)))
         
         ## --------------------------------
         ## output results to verify it
@@ -276,12 +397,12 @@ class Plugin(Layer):
         
         print("+ {} low peaks found".format(lp.shape[1]))
         if show:
-            plt.plot(self.axis**2, self.data, '--', lw=0.5) # raw data
+            plt.plot(res.axis**2, res.data, '--', lw=0.5) # raw data
             ## plt.plot(newaxis, orgdata, '--', lw=1) # original data
             plt.plot(newaxis, newdata, '-', lw=1) # interpolated
             plt.plot(lx, ly, 'v') # low peaks
             plt.plot(hx, hy, '^') # high peaks
-            ## plt.plot(*self.lpoints, 'o') # filtered peaks
+            ## plt.plot(*res.lpoints, 'o') # filtered peaks
             plt.xlabel("Alpha^2")
             plt.grid(True)
             plt.show()
@@ -295,12 +416,12 @@ class Plugin(Layer):
             self.output.load(buf, "*fft of {}*".format(frame.name),
                              localunit=1/w/frame.unit)
             u = self.output.frame.unit
-            eps = np.abs(self.stig)
-            ang = np.angle(self.stig) * 180/pi
+            eps = np.abs(res.stig)
+            ang = np.angle(res.stig) * 180/pi
             
             ## 不特定多数の円を描画する (最大 N まで)
             del self.Arts
-            for x in self.lpoints[0,:10]:
+            for x in res.lpoints[0,:10]:
                 r = N * np.sqrt(x)
                 art = patches.Circle((0, 0), 0, color='r',
                                      ls='--', lw=0.5, fill=0, alpha=0.5)
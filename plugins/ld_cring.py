@@ -5,28 +5,12 @@ import ld_ring as base
 
 
 class Model(base.Model):
-    def residual(self, fitting_params, x, y):
-        """最小自乗法の剰余函数"""
-        self.owner.thread.check()
-        
-        xc, yc = 0, 0
+    columns = [0, 3, 4] # cam, ratio, phi
+    
+    def expand(self, fitting_params):
+        """Full model params with fixed origin center."""
         cam, ratio, phi = fitting_params
-        z = base.calc_aspect(x + 1j*y, 1/ratio, phi) # z = x+iy --> 逆変換 1/r
-        
-        ## φ超過時の補正
-        if not -90 < phi < 90:
-            ## print("  warning! phi is over limit ({:g})".format(phi))
-            if phi < -90: phi += 180
-            elif phi > 90: phi -= 180
-            fitting_params[2] = phi
-        
-        ## 真円からのズレを評価する
-        x, y = z.real, z.imag
-        rc = cam * self.Angles[self.Index]
-        res = abs((x-xc)**2 + (y-yc)**2 - rc**2)
-        
-        print("\b"*72 + "point({}): residual {:g}".format(len(res), sum(res)), end='')
-        return res
+        return cam, 0, 0, ratio, phi
 
 
 class Plugin(base.Plugin):
@@ -1,8 +1,10 @@
 #! python3
+from functools import lru_cache
 import wx
 import numpy as np
 from numpy import pi,exp,cos,sin
 from scipy import optimize
+from scipy.spatial import cKDTree
 
 from wxpj import Layer, Thread, LParam, Button
 
@@ -16,6 +18,84 @@ def calc_aspect(u, r, t):
     return u + (1-r) * np.conj(u) * exp(2j*t)
 
 
+@lru_cache(maxsize=8)
+def lattice_indices(N):
+    """Integer lattice indices k + il in [-N:N] (複素数配列).
+    The returned array is cached and read-only.
+    """
+    n = np.arange(-N, N+1)
+    X, Y = np.meshgrid(n, n)
+    lc = (X + 1j * Y).ravel()
+    lc.flags.writeable = False
+    return lc
+
+
+def calc_nearest(gr, z):
+    """Squared distances from each point z to the nearest grid point in gr.
+    
+    再近接グリッド点を KD-tree で探索する (全点の総当たりは遅い)．
+    
+    Returns:
+        squared distances and indices of the nearest points in gr
+    """
+    tree = cKDTree(np.column_stack((gr.real, gr.imag)))
+    d, j = tree.query(np.column_stack((z.real, z.imag)))
+    return d**2, j
+
+
+def find_lattice_basis(x, y, k=4, tol=0.3):
+    """Estimate the lattice basis (a1, a2) of markers (複素数).
+    
+    The vectors to the k nearest neighbours of each marker (KD-tree)
+    are clustered into the two directions of the basis, where a2 is
+    rotated about +90 deg from a1.
+    
+    If the markers lie on only one direction (e.g. a single row),
+    a2 is assumed to be a1 rotated by 90 deg (square lattice).
+    
+    Args:
+        k   : number of neighbours of each marker
+        tol : tolerance of the vector lengths to the median NN distance
+    
+    Raises:
+        ValueError if there are less than two markers.
+    """
+    z = np.column_stack((x, y))
+    if len(z) < 2:
+        raise ValueError("too few markers to find the lattice")
+    tree = cKDTree(z)
+    d, j = tree.query(z, k=min(k, len(z)-1) + 1)
+    d, j = d[:,1:], j[:,1:] # exclude self
+    v = ((x[j] - x[:,None]) + 1j * (y[j] - y[:,None])).ravel()
+    
+    ## 最近接距離の中央値に近い長さのベクトルのみ使う
+    g = np.median(d[:,0])
+    sel = abs(abs(v) - g) < tol * g
+    if not sel.any(): # strongly distorted; use the nearest neighbours only
+        sel = np.zeros(d.shape, bool)
+        sel[:,0] = True
+        sel = sel.ravel()
+    v = v[sel & (v != 0)]
+    if not v.size:
+        raise ValueError("markers are overlapped")
+    
+    ## 4 回対称を仮定して主方向 θ0 を求め，±θ0, ±(θ0+90) の２方向に分類する
+    t0 = np.angle(np.sum((v / abs(v)) ** 4)) / 4
+    r = v * exp(-1j * t0) # rotate to the principal axes
+    r[r.real + r.imag < 0] *= -1 # fold v and -v (half plane)
+    sel = abs(r.real) > abs(r.imag)
+    if sel.all():
+        a1 = np.mean(r[sel])
+        a2 = a1 * 1j
+    elif not sel.any():
+        a2 = np.mean(r[~sel])
+        a1 = a2 * -1j
+    else:
+        a1 = np.mean(r[sel])
+        a2 = np.mean(r[~sel])
+    return a1 * exp(1j * t0), a2 * exp(1j * t0)
+
+
 class Model(object):
     """グリッドパターンモデル [mm].
     
@@ -25,6 +105,8 @@ class Model(object):
     """
     nGrid = 30 # number of grid (in x,y) --> (N+1) 本のグリッド線を引く
     
+    report = None # progress hook (cf. editor.FitReport)
+    
     def __init__(self, parent):
         self.owner = parent
     
@@ -41,34 +123,77 @@ class Model(object):
         return [(X + 1j * y) for y in Y]\
              + [(x + 1j * Y) for x in X]
     
-    def residual(self, fitting_params, x, y):
-        """最小自乗法の剰余函数"""
-        self.owner.thread.check()
+    columns = slice(None) # columns of the fitting params in the full model
+    
+    def expand(self, fitting_params):
+        """Full model params (grid, tilt, xc, yc, ratio, phi, D, d)."""
+        return fitting_params
+    
+    def nearest(self, fitting_params, x, y):
+        """Find the nearest grid points of markers.
         
-        grid, tilt, xc, yc, ratio, phi, D, d = fitting_params
+        Returns:
+            f   : deviation of markers from the nearest grid points
+            lc  : lattice indices of the nearest grid points
+        """
+        grid, tilt, xc, yc, ratio, phi, D, d = self.expand(fitting_params)
         z = x + 1j*y
         
-        ## φ超過時の補正
-        if not -90 < phi < 90:
-            ## print("  warning! phi is over limit ({:g})".format(phi))
-            if phi < -90: phi += 180
-            elif phi > 90: phi -= 180
-            fitting_params[5] = phi
-        
         ## 検索範囲（描画範囲ではない）の基準グリッド (-N:N 十分広く設定する)
         N = int(max(np.hypot(x,y)) / grid) + 1
         u = grid * exp(1j * tilt * pi/180)
-        lu = u * np.arange(-N, N+1)
-        X, Y = np.meshgrid(lu, lu)
-        net = (xc + 1j * yc) + (X + 1j * Y).ravel()
+        lc = lattice_indices(N)
+        net = (xc + 1j * yc) + u * lc
         gr = calc_aspect(net, ratio, phi) + calc_dist(net, D, d)
         
         ## 再近接グリッド点からのズレを評価する (探索範囲のリミットを設ける)
         lim = N * grid
-        res = [ min(abs(gr - p))**2 for p in z if abs(p.real) < lim and abs(p.imag) < lim ]
+        z = z[(abs(z.real) < lim) & (abs(z.imag) < lim)]
+        _res, j = calc_nearest(gr, z)
+        return gr[j] - z, lc[j]
+    
+    def residual(self, fitting_params, x, y):
+        """最小自乗法の剰余函数"""
+        self.owner.thread.check()
         
-        print("\b"*72 + "point({}): residual {:g}".format(len(res), sum(res)), end='')
+        f, _lc = self.nearest(fitting_params, x, y)
+        res = abs(f)**2
+        if self.report is not None:
+            self.report(res)
         return res
+    
+    def jacobian(self, fitting_params, x, y):
+        """Jacobian of the residual function (解析的な偏微分).
+        
+        res = |f|^2, f = g(w) - z
+        d(res)/dp = 2 Re(conj(f) dg/dp)
+        """
+        grid, tilt, xc, yc, ratio, phi, D, d = self.expand(fitting_params)
+        f, lc = self.nearest(fitting_params, x, y)
+        
+        t = tilt * pi/180
+        u = grid * exp(1j * t)
+        w = (xc + 1j * yc) + u * lc # nearest grid points (before distortion)
+        e = (1 - ratio)
+        E = exp(2j * phi * pi/180)
+        C = complex(D, d)
+        wc = np.conj(w)
+        
+        def dg(dw): # response of g(w) to the shift dw
+            return dw + e * E * np.conj(dw) + C * (2 * w * wc * dw + w * w * np.conj(dw))
+        
+        G = np.array((
+            dg(exp(1j * t) * lc),           # grid
+            dg(1j * u * lc * pi/180),       # tilt
+            dg(np.ones_like(w)),            # xc
+            dg(1j * np.ones_like(w)),       # yc
+            -wc * E,                        # ratio
+            2j * e * wc * E * pi/180,       # phi
+            w * w * wc,                     # D
+            1j * w * w * wc,                # d
+        ))
+        J = 2 * (np.conj(f) * G).real
+        return J[self.columns].T
 
 
 class Plugin(Layer):
@@ -81,6 +206,34 @@ class Plugin(Layer):
     fitting_params = property(
         lambda self: self.grid_params + self.ratio_params + self.dist_params)
     
+    @property
+    def fitting_bounds(self):
+        """Bounds of the fitting params.
+        
+        γ is bounded by the knob range. φ has the period of 180 deg, so it is
+        bounded by ±180 deg (not to be pinned at ±90) and wrapped after fitting.
+        """
+        ratio, phi = self.ratio_params
+        lb = [(ratio.min if lp is ratio else -180 if lp is phi else -np.inf)
+              for lp in self.fitting_params]
+        ub = [(ratio.max if lp is ratio else 180 if lp is phi else np.inf)
+              for lp in self.fitting_params]
+        return lb, ub
+    
+    def set_fitting_values(self, values):
+        """Set the fitted values to the params (φ is wrapped into (-90:90])."""
+        _ratio, phi = self.ratio_params
+        for lp, v in zip(self.fitting_params, values):
+            if lp is phi:
+                v = 90 - (90 - v) % 180
+            lp.value = v
+    
+    @property
+    def fitting_values(self):
+        """Initial values of the fitting params (clipped into the bounds)."""
+        lb, ub = self.fitting_bounds
+        return np.clip(np.float64(self.fitting_params), lb, ub)
+    
     def Init(self):
         self.thread = Thread(self)
         
@@ -186,43 +339,60 @@ class Plugin(Layer):
         ## 初期グリッドパラメータの見積もり
         if not skip:
             print("estimating initial grid paramtres... order(0)")
-            self.find_init_grid(x, y)
+            try:
+                self.find_init_grid(x, y)
+            except ValueError as e:
+                self.message("- Abort: {}".format(e))
+                return
         
         ## 最適グリッドパラメータの見積もり
         order = self.order.value
+        report = self.model.report = self.edi.FitReport(self.message, interval=0.5)
         if order > 0:
-            result = optimize.leastsq(self.model.residual,
-                                np.float32(self.fitting_params),
+            result = optimize.least_squares(self.model.residual,
+                                self.fitting_values,
+                                jac=self.model.jacobian,
+                                bounds=self.fitting_bounds,
                                 args=(x,y), ftol=10**-order)
             
-            for lp, v in zip(self.fitting_params, result[0]):
-                lp.value = v
+            self.set_fitting_values(result.x)
         
         ## check the final result
         res = self.model.residual(np.float32(self.fitting_params), x, y)
         
         print("... refined with order({})".format(order),
-              ":res {:g}".format(np.sqrt(np.average(res)) / frame.unit))
+              ":res {:g}".format(np.sqrt(np.average(res)) / frame.unit),
+              "({} calls, {:.3f} s)".format(report.count, report.elapsed))
+        self.model.report = None
         self.calc()
         
         frame.annotation = ', '.join(self.text.Value.splitlines())
     
     def find_init_grid(self, x, y):
-        """Find the initial grid position."""
-        lx = []
-        ly = []
-        ld = []
-        for i in range(len(x)):
-            d = np.hypot(x-x[i], y-y[i])
-            d[i] = np.inf
-            j = d.argmin() # j-i 近接スポット間の距離のうち最小のやつ
-            ld.append(d[j])
-            lx.append(x[j] - x[i])
-            ly.append(y[j] - y[i])
-            
-        ## k = ld.index(np.median(ld))
-        k = ld.index(np.percentile(ld, 50, method='nearest'))
-        g = ld[k]
-        t = np.arctan(ly[k]/lx[k]) * 180/pi
-        for lp, v in zip(self.grid_params, (g, t, x[0], y[0])):
+        """Find the initial grid position.
+        
+        The grid and aspect params are estimated from the lattice basis
+        (a1, a2) assuming a1 = g(u), a2 = g(iu), where g is the aspect map:
+        
+            g(z) = z + w conj(z),  w = (1-γ) exp(2iφ)
+        """
+        a1, a2 = find_lattice_basis(x, y)
+        u = (a1 - 1j * a2) / 2
+        w = (a1 + 1j * a2) / 2 / np.conj(u)
+        
+        ## 90 度回転の自由度を tilt の範囲 [-45:45] で一意にする
+        u *= 1j ** -np.round(np.angle(u) / (pi/2))
+        
+        ## 中心の初期値は先頭のマーカー位置 z0 = c + w conj(c)
+        z0 = x[0] + 1j * y[0]
+        c = (z0 - w * np.conj(z0)) / (1 - abs(w)**2)
+        
+        g = abs(u)
+        t = np.angle(u) * 180/pi
+        for lp, v in zip(self.grid_params, (g, t, c.real, c.imag)):
+            lp.value = v
+        
+        r = 1 - abs(w)
+        p = np.angle(w) / 2 * 180/pi
+        for lp, v in zip(self.ratio_params, (r, p)):
             lp.value = v
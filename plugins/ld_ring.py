@@ -1,7 +1,9 @@
 #! python3
+from functools import lru_cache
 import wx
 import numpy as np
 from numpy import pi,exp,cos,sin
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy import optimize
 
 from wxpj import Layer, Thread, LParam, Button
@@ -16,33 +18,133 @@ def calc_aspect(u, r, t):
     return u + (1-r) * np.conj(u) * exp(2j*t)
 
 
+def find_near_maximum(src, nx, ny, n=5, times=2, subpix=False):
+    """Find the nearest maximum peak position
+    in the specified region and number of loops.
+    
+    All markers are evaluated at once in windows (2n+1)^2 gathered from
+    the padded src, so that the markers near the border are also kept.
+    
+    Args:
+        nx, ny  : marker positions [pix]
+        subpix  : refine the positions by the centroid of 3x3 pixels
+    
+    Returns:
+        nx, ny (float if subpix) of the same length as the markers
+    """
+    h, w = src.shape
+    nx = np.clip(np.asarray(nx, dtype=int), 0, w-1)
+    ny = np.clip(np.asarray(ny, dtype=int), 0, h-1)
+    buf = np.pad(src, n, mode='constant', constant_values=src.min())
+    m = 2*n+1
+    
+    ## Note: Gaussian をかけるので実際のピーク位置とずれることがある．
+    windows = sliding_window_view(buf, (m, m)) # windows[y, x] is centered at (x, y)
+    for _ in range(times):
+        j = windows[ny, nx].reshape(len(nx), -1).argmax(axis=1)
+        ly, lx = np.divmod(j, m)
+        nx = np.clip(nx + lx - n, 0, w-1)
+        ny = np.clip(ny + ly - n, 0, h-1)
+    if subpix:
+        z = sliding_window_view(buf, (3, 3))[ny+n-1, nx+n-1].astype(float)
+        z -= z.min(axis=(1,2), keepdims=True)
+        s = z.sum(axis=(1,2))
+        s[s == 0] = 1
+        dx = (z.sum(axis=1) @ [-1, 0, 1]) / s
+        dy = (z.sum(axis=2) @ [-1, 0, 1]) / s
+        return nx + dx, ny + dy
+    return nx, ny
+
+
+def _selection_rule(lattice, h, k, l):
+    """Reflection conditions of the lattice (消滅則).
+    """
+    if lattice == 'sc':
+        return np.ones(h.shape, dtype=bool)
+    if lattice == 'bcc':
+        return (h+k+l) % 2 == 0
+    if lattice == 'fcc':
+        return ((h+k) % 2 == 0) & ((k+l) % 2 == 0)
+    if lattice == 'diamond':
+        return ((h+k) % 2 == 0) & ((k+l) % 2 == 0) & ((h % 2 == 1) | ((h+k+l) % 4 == 0))
+    if lattice == 'hcp':
+        return ~((l % 2 == 1) & ((h + 2*k) % 3 == 0))
+    raise ValueError(f"unknown lattice type: {lattice!r}")
+
+
+@lru_cache(maxsize=16)
+def calc_spacings(a, N=10, lattice='fcc'):
+    """Calc reciprocal lattice distance (lattice < N).
+    
+    Args:
+        a       : lattice constant [m]
+                  For hcp, (a, c) tuple.
+        N       : index range of the reciprocal lattice
+        lattice : 'sc', 'bcc', 'fcc', 'diamond', or 'hcp'
+    
+    Returns:
+        d-spacings in descending order (n=0 excluded).
+        The returned array is cached and read-only.
+    """
+    if lattice == 'hcp':
+        a, c = a
+        h, k = np.mgrid[-N+1:N, -N+1:N].reshape(2, -1, 1)
+        l = np.arange(N)
+        q = 4/3 * (h*h + h*k + k*k) + l*l * (a/c)**2
+        h, k, l = np.broadcast_arrays(h, k, l)
+        q = np.round(q[_selection_rule(lattice, h, k, l)], 9)
+    else:
+        h, k, l = np.indices((N, N, N))
+        q = (h*h + k*k + l*l)[_selection_rule(lattice, h, k, l)]
+    q = np.unique(q) # sorted
+    lr = a / np.sqrt(q[q > 0])
+    lr.flags.writeable = False
+    return lr
+
+
 def calc_fcc_spacings(a, N=10):
     """Calc reciprocal lattice distance (lattice < N).
     a: lattice constant for FCC
     """
-    ln = range(N)
-    ls = {(i*i + j*j + k*k)
-            for i in ln for j in ln for k in ln
-                if not((i+j)%2 or (j+k)%2 or (k+i)%2)}
-    lr = a / np.sqrt(np.array(sorted(ls-{0})))
-    return lr
+    return calc_spacings(a, N, 'fcc')
 
 
 class Model(object):
-    """FCC 多結晶リングパターンモデル
+    """多結晶リングパターンモデル (default: Au FCC)
     
     Angles  : scattering angles [rad] (n=0 included)
     cam     : camera length [mm]
     xc, yc  : position of center
+    
+    The spacing table is given by `lattice` and `lattice_constant`,
+    or user-supplied `dspacings` [m] if specified.
     """
     nGrid = 10 # 逆格子グリッド
     Index = 2  # fitting ring index (default 3rd ring)
     
+    lattice = 'fcc'
+    lattice_constant = 4.080e-10 # Au [m]; (a, c) for hcp
+    dspacings = None # user-supplied d-spacings [m]
+    
+    __key = None # cache key of Angles
+    
     @property
     def Angles(self):
-        le = self.owner.em.elambda
-        ds = calc_fcc_spacings(a=4.080e-10, N=self.nGrid)
-        return sorted(le / ds)[:20]
+        ## Note: 剰余函数から毎回呼ばれるのでキャッシュする．
+        ##       加速電圧 (startup.set_htv) を変えたときだけ再計算される．
+        em = self.owner.em
+        ds = self.dspacings
+        if ds is not None:
+            ds = tuple(ds)
+        key = (self.lattice, self.lattice_constant, self.nGrid, ds, em.acc_v)
+        if key != self.__key:
+            if ds is None:
+                ds = calc_spacings(self.lattice_constant, self.nGrid, self.lattice)
+            self.__angles = tuple(sorted(em.elambda / np.array(ds))[:20])
+            self.__key = key
+        return self.__angles
+    
+    report = None # progress hook (cf. editor.FitReport)
     
     def __init__(self, parent):
         self.owner = parent
@@ -56,27 +158,60 @@ class Model(object):
         p = complex(xc, yc)
         return [p + cam * a * exp(2j*t) for a in self.Angles]
     
-    def residual(self, fitting_params, x, y):
-        """最小自乗法の剰余函数"""
-        self.owner.thread.check()
+    columns = slice(None) # columns of the fitting params in the full model
+    
+    def expand(self, fitting_params):
+        """Full model params (cam, xc, yc, ratio, phi)."""
+        return fitting_params
+    
+    def deviation(self, fitting_params, x, y):
+        """Deviation from the true circle.
         
-        cam, xc, yc, ratio, phi = fitting_params
+        Returns:
+            s   : |z - c|^2 - rc^2
+            z   : inverse-transformed marker positions
+        """
+        cam, xc, yc, ratio, phi = self.expand(fitting_params)
         z = calc_aspect(x + 1j*y, 1/ratio, phi) # z = x+iy --> 逆変換 1/r
         
-        ## φ超過時の補正
-        if not -90 < phi < 90:
-            ## print("  warning! phi is over limit ({:g})".format(phi))
-            if phi < -90: phi += 180
-            elif phi > 90: phi -= 180
-            fitting_params[4] = phi
-        
         ## 真円からのズレを評価する
         x, y = z.real, z.imag
         rc = cam * self.Angles[self.Index]
-        res = abs((x-xc)**2 + (y-yc)**2 - rc**2)
+        return (x-xc)**2 + (y-yc)**2 - rc**2, z
+    
+    def residual(self, fitting_params, x, y):
+        """最小自乗法の剰余函数"""
+        self.owner.thread.check()
         
-        print("\b"*72 + "point({}): residual {:g}".format(len(res), sum(res)), end='')
+        s, _z = self.deviation(fitting_params, x, y)
+        res = abs(s)
+        if self.report is not None:
+            self.report(res)
         return res
+    
+    def jacobian(self, fitting_params, x, y):
+        """Jacobian of the residual function (解析的な偏微分).
+        
+        res = |s|, s = |z' - c|^2 - rc^2
+        d(res)/dp = sign(s) ds/dp
+        """
+        cam, xc, yc, ratio, phi = self.expand(fitting_params)
+        s, z = self.deviation(fitting_params, x, y)
+        
+        a = self.Angles[self.Index]
+        v = np.conj(z - complex(xc, yc))
+        zc = np.conj(x + 1j*y)
+        E = exp(2j * phi * pi/180)
+        
+        J = np.array((
+            np.full_like(s, -2 * cam * a * a),              # cam
+            -2 * v.real,                                    # xc
+            2 * v.imag,                                     # yc
+            2 * (v * zc * E / ratio**2).real,               # ratio
+            2 * (v * (1 - 1/ratio) * zc * E * 2j * pi/180).real, # phi
+        ))
+        J *= np.sign(s)
+        return J[self.columns].T
 
 
 class Plugin(Layer):
@@ -92,6 +227,34 @@ class Plugin(Layer):
     fitting_params = property(
         lambda self: self.grid_params + self.ratio_params)
     
+    @property
+    def fitting_bounds(self):
+        """Bounds of the fitting params.
+        
+        γ is bounded by the knob range. φ has the period of 180 deg, so it is
+        bounded by ±180 deg (not to be pinned at ±90) and wrapped after fitting.
+        """
+        ratio, phi = self.ratio_params
+        lb = [(ratio.min if lp is ratio else -180 if lp is phi else -np.inf)
+              for lp in self.fitting_params]
+        ub = [(ratio.max if lp is ratio else 180 if lp is phi else np.inf)
+              for lp in self.fitting_params]
+        return lb, ub
+    
+    def set_fitting_values(self, values):
+        """Set the fitted values to the params (φ is wrapped into (-90:90])."""
+        _ratio, phi = self.ratio_params
+        for lp, v in zip(self.fitting_params, values):
+            if lp is phi:
+                v = 90 - (90 - v) % 180
+            lp.value = v
+    
+    @property
+    def fitting_values(self):
+        """Initial values of the fitting params (clipped into the bounds)."""
+        lb, ub = self.fitting_bounds
+        return np.clip(np.float64(self.fitting_params), lb, ub)
+    
     def Init(self):
         self.thread = Thread(self)
         
@@ -201,36 +364,31 @@ class Plugin(Layer):
         
         ## 最適グリッドパラメータの見積もり
         self.model.Index = self.order.value - 1
+        report = self.model.report = self.edi.FitReport(self.message, interval=0.5)
         
-        result = optimize.leastsq(self.model.residual,
-                            np.float32(self.fitting_params),
+        result = optimize.least_squares(self.model.residual,
+                            self.fitting_values,
+                            jac=self.model.jacobian,
+                            bounds=self.fitting_bounds,
                             args=(x,y), ftol=1e-6)
         
-        for lp, v in zip(self.fitting_params, result[0]):
-            lp.value = v
+        self.set_fitting_values(result.x)
         
         ## Check the final result.
         res = self.model.residual(np.float32(self.fitting_params), x, y)
         
         print("... refined with order({})".format(6),
-              ":res {:g}".format(np.sqrt(np.average(res)) / frame.unit))
+              ":res {:g}".format(np.sqrt(np.average(res)) / frame.unit),
+              "({} calls, {:.3f} s)".format(report.count, report.elapsed))
+        self.model.report = None
         self.calc()
         
         frame.annotation = ', '.join(self.text.Value.splitlines())
     
-    def find_near_maximum(self, src, nx, ny, n=5, times=2):
+    def find_near_maximum(self, src, nx, ny, n=5, times=2, subpix=False):
         """Find the nearest maximum peak position
         in the specified region and number of loops.
+        
+        cf. find_near_maximum (module function)
         """
-        h, w = src.shape
-        
-        ## Note: Gaussian をかけるので実際のピーク位置とずれることがある．
-        for x in range(times):
-            pp = []
-            for x, y in zip(nx, ny):
-                if n < x < w-n and n < y < h-n:
-                    buf = src[y-n:y+n+1, x-n:x+n+1] # crop around (x,y)
-                    ly, lx = np.unravel_index(np.argmax(buf), buf.shape)
-                    pp.append((x+lx-n, y+ly-n))
-            nx, ny = np.array(pp).T
-        return nx, ny
+        return find_near_maximum(src, nx, ny, n, times, subpix)
@@ -1,10 +1,16 @@
 #! python3
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+import wx
 import numpy as np
 from numpy import pi
 from scipy import optimize
 from matplotlib import pyplot as plt
 
-from wxpj import Layer, LParam, Button
+from wxpj import TemLayer, Thread, LParam, Button, ToggleButton
+import editor as edi
+from lctf import ring_stage, peak_stage
 
 
 def _make_indices(i, j, N):
@@ -22,7 +28,203 @@ def make_indices_matrix(n):
                      for j in np.arange(0, n-0.5, 0.5)], dtype=int)
 
 
-class Plugin(Layer):
+def fit_offsets(x, yy, A):
+    """Fit b of the index pattern y = A x^2 + b x for each row of yy.
+    
+    All candidates are evaluated at once in closed form.
+    The objective is sum(r^4) (cf. leastsq of the squared residual r^2),
+    which is refined from the linear least-squares solution by Newton's method.
+    
+    Returns:
+        b   : optimized coefficients for each row
+        res : sum of the squared residuals r^2 for each row
+    """
+    c = A*x**2 - yy                 # r = c + b x
+    b = -(c @ x) / (x @ x)          # linear least-squares (initial guess)
+    for _ in range(100):
+        r = c + b[:,None] * x
+        g = (r**3) @ x              # d(sum(r^4))/db / 4
+        H = 3 * (r**2) @ (x*x)      # d^2(sum(r^4))/db^2 / 4
+        db = np.divide(g, H, out=np.zeros_like(g), where=H>0)
+        b -= db
+        if np.all(abs(db) <= 1e-12 * (1 + abs(b))):
+            break
+    r = c + b[:,None] * x
+    return b, (r**2).sum(axis=1)
+
+
+def eval_optvar(xx, stig, u, elambda, cs, limit=10, debug=False):
+    """Evaluate optical variables.
+    
+    Args:
+        xx      : selected peak points of x:ref (cf. lctf.eval_peak)
+        stig    : astigmatism (cf. lctf.eval_ring)
+        u       : unit length [m/pix]
+        elambda : electron wave length [m]
+        cs      : design value of Cs [m]
+        limit   : maximum index for fitting
+    
+    Returns:
+        df      : defocus [m] (-under, +over)
+        A       : astigmatism (complex) [m]
+        cs      : estimated Cs [m]
+        (a, b, yy) : fitting coefficients and indices
+        
+        or None if fitting failed.
+    """
+    K = 1 / elambda # [1/m] wave vector
+    A = cs * K/2 / (K * u)**4 # expected cs value
+    
+    ## --------------------------------
+    ## The first trial of optimization 
+    ## --------------------------------
+    ## index オフセットの最適値を探索する (Cs 設計値を用いる)
+    ## 全候補のインデクス列 (over-focus + under-focus) を一括して評価する
+    n = min(limit, len(xx))
+    while n > 1:
+        x = xx[:n]
+        yy = np.vstack((
+            np.arange(0, n) + np.arange(n, 0, -1)[:,None], # over-focus
+            (make_indices_matrix(n)[None,:,:]
+                - np.arange(0, n)[:,None,None]).reshape(-1, n), # under-focus
+        ))
+        b, lres = fit_offsets(x, yy, A)
+        ya = np.round(A*x**2 + b[:,None]*x).astype(int)
+        ok = np.all(ya == yy, axis=1) & (lres != 0) # 整数列パターンが合致するときだけ
+        if debug:
+            for y, bj, res in zip(ya[ok], b[ok], lres[ok]):
+                df = bj / K * (K * u)**2
+                print("  {}, {:.1f} mm, res: {:g}".format(y, df*1e9, res))
+        if np.any(ok):
+            lres = lres[ok]
+            lyy = yy[ok]
+            break
+        n -= 1
+    else:
+        return None
+    
+    k = np.argmin(lres)
+    yy = lyy[k]
+    n = len(yy)
+    
+    ## --------------------------------
+    ## The second trial of fitting
+    ## --------------------------------
+    ## Cs 設計値に近い条件を探す (残差の最小値では曖昧さが残る)
+    def residual(params, x, y):
+        a, b = params
+        return (a*x**2 + b*x - y)**2
+    
+    ## インデクスオフセットの最適値は最初のトライアルで決定されている
+    x = xx[:n]
+    y = yy[:n]
+    result = optimize.leastsq(residual, [A, 0], args=(x, y))
+    a, b = result[0]
+    
+    ## --------------------------------
+    ## Evaluation of optical consts
+    ## --------------------------------
+    ## cs の見積もりは誤差が大きいので参考のみ
+    cs = a * 2/K * (K * u)**4
+    
+    ## デフォーカス (-under, +over)
+    df = b / K * (K * u)**2
+    
+    ## CTFFIND の結果は 1/4 定義 ?(楕円の正規化 1/2, 非点の定義 1/2)
+    A = stig * df * (K * u)
+    return df, A, cs, (a, b, yy)
+
+
+def optvar_stage(res, u, elambda, cs, limit=10, debug=False):
+    """Stage 3: optical variables (cf. eval_optvar).
+    
+    Returns:
+        Result(..., u, df, A, cs, fit) or None if fitting failed.
+    """
+    ret = eval_optvar(res.lpoints[0], res.stig, u, elambda, cs, limit, debug)
+    if ret is None:
+        return None
+    df, A, cs, fit = ret
+    return res.updated(u=u, df=df, A=A, cs=cs, fit=fit)
+
+
+## Failures expected for frames without (enough) ring pattern.
+## Note: leastsq raises TypeError if there are fewer points than the parameters.
+FitErrors = (ValueError, TypeError, np.linalg.LinAlgError)
+
+
+def eval_image(src, rmin, rmax, tol, u, elambda, cs, limit=10, tile=0):
+    """Evaluate optical variables of the src image (no GUI, no output).
+    
+    Args:
+        src     : image buffer
+        rmin    : min radius ratio of ring (cf. lctf.rmin)
+        rmax    : max radius ratio of ring (cf. lctf.rmax)
+        tol     : tolerance of peak detection (cf. lctf.tol)
+        tile    : tile size of the Welch spectrum (0: fftcrop)
+        (others are the same as eval_optvar)
+    
+    Returns:
+        lctf.Result of all stages, or None if fitting failed.
+    """
+    if not tile:
+        src = edi.fftcrop(src)
+    try:
+        res = ring_stage(src, rmin, rmax, tile=tile)
+        res = peak_stage(res, tol)
+    except FitErrors: # e.g. no ring pattern in the frame
+        return None
+    return optvar_stage(res, u, elambda, cs, limit)
+
+
+def _eval_source(source, **kwargs):
+    """Worker of eval_batch; source is (name, path or buffer)."""
+    name, src = source
+    try:
+        if isinstance(src, str):
+            src, _info = edi.read_buffer(src)
+        if src.ndim > 2:
+            src = src.mean(axis=2) # RGB -> gray
+        res = eval_image(src, **kwargs)
+    except Exception as e: # report in the table instead of stopping the batch
+        return (name, np.nan, np.nan, np.nan, np.nan, "{}: {}".format(type(e).__name__, e))
+    if res is None:
+        return (name, np.nan, np.nan, np.nan, np.nan, "no solution")
+    return (name, res.df, np.abs(res.A), np.angle(res.A) * 180/pi, res.cs, "")
+
+
+def eval_batch(sources, processes=None, **kwargs):
+    """Fit CTF of many images in a process pool (headless).
+    
+    Args:
+        sources   : list of file paths, buffers, or (name, buffer) pairs
+        processes : number of worker processes (default: cpu count)
+        **kwargs  : parameters of eval_image
+    
+    Returns:
+        record array of (name, df [m], ast [m], phi [deg], cs [m], error).
+        The values are NaN if fitting failed, and the reason is in error.
+    """
+    items = []
+    for i, src in enumerate(sources):
+        if isinstance(src, str):
+            items.append((os.path.basename(src), src))
+        elif isinstance(src, tuple):
+            items.append(src)
+        else:
+            items.append(("#{}".format(i), src))
+    if not items:
+        return None
+    worker = partial(_eval_source, **kwargs)
+    if processes == 1 or len(items) == 1:
+        rows = [worker(item) for item in items]
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            rows = list(executor.map(worker, items))
+    return np.rec.fromrecords(rows, names="name,df,ast,phi,cs,error")
+
+
+class Plugin(TemLayer):
     """Pragma suite for CTF analysis.
     """
     menukey = "CTF/"
@@ -59,10 +261,29 @@ class Plugin(Layer):
             None,
             Button(self, "CTF", self.execute, icon='->'),
             Button(self, "clf", plt.clf, icon='-'),
+            Button(self, "Batch", lambda v: self.batch_thread.Start(self.execute_batch), icon='->'),
             ),
             row=2,
             type='vspin', style='button', cw=-1, lw=32, tw=50,
         )
+        self.thread = Thread(self) # live analysis
+        self.batch_thread = Thread(self)
+        
+        self.live_btn = ToggleButton(self, "Live", self.toggle_live, icon='camera')
+        
+        self.text = wx.TextCtrl(self, size=(160,60),
+                                style=wx.TE_READONLY|wx.TE_MULTILINE)
+        self.layout((
+            self.live_btn,
+            self.text,
+            ),
+            title="Live CTF", show=0,
+        )
+    
+    def Destroy(self):
+        self.thread.active = 0
+        self.batch_thread.active = 0
+        return TemLayer.Destroy(self)
     
     def calc_sherzer(self):
         """Sherzer focus [m] defined as sin(2*pi/3) = 0.866
@@ -86,85 +307,29 @@ class Plugin(Layer):
         
         Referenced limit is maximum index for fitting.
         """
-        xx = self.lctf.lpoints[0] # selected peak points of x:ref
-        ## yy = np.arange(len(xx)) # selected peak indices # ▲昇順のみを仮定している
+        res = self.lctf.result
+        if res is None or not hasattr(res, 'lpoints'):
+            self.message("- no data.")
+            return False
         
+        xx = res.lpoints[0] # selected peak points of x:ref
         u = self.ru.value * 1e-10 # [m/pix]
-        K = 1 / self.em.elambda   # [1/m] wave vector
         
-        cs = self.cs.value * 1e-3
-        A = cs * K/2 / (K * u)**4 # expected cs value
-        
-        ## --------------------------------
-        ## The first trial of optimization 
-        ## --------------------------------
-        ## index オフセットの最適値を探索する (Cs 設計値を用いる)
-        def residual1(params, x, y):
-            b, = params
-            return (A*x**2 + b*x - y)**2
-        
-        def optimize_index(x, y):
-            result = optimize.leastsq(residual1, [0], args=(x, y))
-            res = sum(residual1(result[0], x, y))
-            b, = result[0]
-            ya = np.round(A*x**2 + b*x).astype(int)
-            if np.all(ya == y): # 整数列パターンが合致するときだけ解を返す
-                if self.debug:
-                    df = b / K * (K * u)**2
-                    print("  {}, {:.1f} mm, res: {:g}".format(ya, df*1e9, res))
-                return res
-        
-        n = min(self.limit.value, len(xx))
-        lres = []
-        lyy = []
-        while n > 1:
-            yy = np.arange(0, n)
-            for i in range(n, 0, -1): # over-focus
-                x = xx[:n]
-                y = yy + i
-                res = optimize_index(x, y)
-                if res:
-                    lres.append(res)
-                    lyy.append(y)
-            yy = make_indices_matrix(n)
-            for i in range(0, n): # under-focus
-                x = xx[:n]
-                for y in (yy - i):
-                    res = optimize_index(x, y)
-                    if res:
-                        lres.append(res)
-                        lyy.append(y)
-            if lres:
-                break
-            n -= 1
-        else:
+        res = optvar_stage(res, u, self.em.elambda,
+                           self.cs.value * 1e-3, self.limit.value, self.debug)
+        if res is None:
             print("- No solution. Fitting failed.")
             return False
         
-        print("+ {} peaks are used for fitting.".format(n))
-        k = np.argmin(lres)
-        yy = lyy[k]
+        df, A, cs, (a, b, yy) = res.df, res.A, res.cs, res.fit
         n = len(yy)
+        print("+ {} peaks are used for fitting.".format(n))
         print("The first trial indices({}) are {}".format(len(xx[:n]), yy))
         
-        ## --------------------------------
-        ## The second trial of fitting
-        ## --------------------------------
-        ## Cs 設計値に近い条件を探す (残差の最小値では曖昧さが残る)
-        def residual(params, x, y):
-            a, b = params
-            return (a*x**2 + b*x - y)**2
-        
-        ## インデクスオフセットの最適値は最初のトライアルで決定されている
-        x = xx[:n]
-        y = yy[:n]
-        result = optimize.leastsq(residual, [A, 0], args=(x, y))
-        a, b = result[0]
-        
         if show:
-            plt.plot(self.lctf.axis**2, self.lctf.data, '--', lw=0.5) # original
-            plt.plot(self.lctf.newaxis, self.lctf.newdata, '-') # interpolated
-            plt.plot(*self.lctf.lpoints, 'o') # filtered peaks
+            plt.plot(res.axis**2, res.data, '--', lw=0.5) # original
+            plt.plot(res.newaxis, res.newdata, '-') # interpolated
+            plt.plot(*res.lpoints, 'o') # filtered peaks
             
             ## x = np.linspace(0, 0.1, 1000)
             x = np.arange(0, xx[n-1] * 2, 1e-4)
@@ -173,18 +338,6 @@ class Plugin(Layer):
             plt.grid(True)
             plt.show()
         
-        ## --------------------------------
-        ## Evaluation of optical consts
-        ## --------------------------------
-        ## cs の見積もりは誤差が大きいので参考のみ
-        cs = a * 2/K * (K * u)**4
-        
-        ## デフォーカス (-under, +over)
-        df = b / K * (K * u)**2
-        
-        ## CTFFIND の結果は 1/4 定義 ?(楕円の正規化 1/2, 非点の定義 1/2)
-        A = self.lctf.stig * df * (K * u)
-        
         print("The fitting results are as follows:",
               "Acc_v = {:,g} V".format(self.em.acc_v),
               "  u = {:g} A/pix".format(u * 1e10),
@@ -210,3 +363,92 @@ class Plugin(Layer):
         self.lctf.calc_ring(show=0)
         self.lctf.calc_peak(show=0)
         self.calc_optvar(show=1)
+    
+    def execute_batch(self, sources=None, processes=None):
+        """Fit CTF of the frames (or files) in a process pool.
+        
+        If sources is None, all frames in the graph are used.
+        """
+        if sources is None:
+            sources = [(art.name, art.buffer) for art in self.graph.get_all_frames()]
+        table = eval_batch(sources, processes, **self.eval_params)
+        if table is None:
+            return None
+        print('-' * 32)
+        print("{:<24} {:>10} {:>10} {:>8} {:>8}".format(
+              "name", "df* [nm]", "Ast [nm]", "phi", "cs* [mm]"))
+        for name, df, ast, phi, cs, error in table:
+            print("{:<24} {:10.2f} {:10.2f} {:8.1f} {:8.3f}  {}".format(
+                  name, df * 1e9, ast * 1e9, phi, cs * 1e3, error))
+        return table
+    
+    ## --------------------------------
+    ## Live CTF analysis
+    ## --------------------------------
+    
+    def toggle_live(self, evt):
+        """Start/Stop continuous CTF analysis of live camera frames.
+        
+        The camera system is specified by `camerasys`.
+        """
+        if evt.IsChecked():
+            grabber = self.acquisition
+            if grabber is None:
+                self.message("- No camera to capture:", self.camerasys)
+                self.live_btn.Value = False
+                return
+            self.thread.Start(self.run_live, grabber)
+        else:
+            self.thread.active = 0
+    
+    def run_live(self, grabber):
+        """Run the CTF pipeline on the newest camera frames.
+        
+        The frames are captured in the background, and frames that
+        arrive while analysing are dropped except for the newest one.
+        The polar maps (and FFT plans) are reused between frames.
+        """
+        try:
+            grabber.start()
+            n = 0
+            while self.thread.active and grabber.active:
+                frame = grabber.get(n, timeout=1)
+                if frame is None:
+                    continue
+                buf, _t, n = frame
+                res = self.eval_frame(buf)
+                wx.CallAfter(self.show_live, res, n)
+        finally:
+            grabber.stop()
+            wx.CallAfter(self.live_btn.SetValue, False)
+    
+    @property
+    def eval_params(self):
+        """Current parameters of eval_image."""
+        return dict(
+            rmin = self.lctf.rmin.value,
+            rmax = self.lctf.rmax.value,
+            tol = self.lctf.tol.value,
+            tile = self.lctf.tile.value,
+            u = self.ru.value * 1e-10,
+            elambda = self.em.elambda,
+            cs = self.cs.value * 1e-3,
+            limit = self.limit.value,
+        )
+    
+    def eval_frame(self, src):
+        """Evaluate optical variables of the src image (no GUI, no output)."""
+        return eval_image(src, **self.eval_params)
+    
+    def show_live(self, res, n):
+        if not self:
+            return
+        if res is None:
+            self.text.Value = "[{}] no solution".format(n)
+            return
+        df, A = res.df, res.A
+        self.text.Value = "\n".join((
+            "[{}] df* = {:g} nm".format(n, df * 1e9),
+            "Ast = {:g} nm".format(np.abs(A) * 1e9),
+            "phi = {:g} deg".format(np.angle(A) * 180/pi),
+        ))
@@ -0,0 +1,205 @@
+#! python3
+import wx
+import numpy as np
+from numpy import pi
+from mwx.matplot2 import MatplotPanel
+
+from wxpj import TemLayer, Thread, Param, LParam, ToggleButton, Choice
+import editor as edi
+
+
+class DriftTracker(object):
+    """Drift tracking against a rolling reference.
+    
+    The shift of each frame is evaluated by phase correlation against the
+    reference frame, whose spectrum is cached until the reference is renewed.
+    
+    Args:
+        refresh  : number of frames to renew the reference
+        upsample : upsampling factor of the sub-pixel refinement
+    """
+    def __init__(self, refresh=10, upsample=20):
+        self.refresh = refresh
+        self.upsample = upsample
+        self.reset()
+    
+    def reset(self):
+        self.reference = None   # <PhaseCorrelator>
+        self.origin = np.zeros(2) # position of the reference [pix]
+        self.position = np.zeros(2) # cumulative drift (x, y) [pix]
+        self.count = 0
+        self.time = None
+    
+    def renew(self):
+        """Renew the reference at the next frame (e.g. after compensation)."""
+        self.reference = None
+    
+    def __call__(self, src, t):
+        """Evaluate the drift of src captured at time t [s].
+        
+        Returns:
+            position (x, y) [pix] and drift rate (vx, vy) [pix/s],
+            or None for the rate if src is a new reference.
+        """
+        rate = None
+        if self.reference is not None and src.shape == self.reference.shape:
+            pos = self.origin + self.reference(src)
+            if t > self.time:
+                rate = (pos - self.position) / (t - self.time)
+            self.position = pos
+            self.count += 1
+        if (self.reference is None or self.count >= self.refresh
+                or src.shape != self.reference.shape):
+            self.reference = edi.PhaseCorrelator(src, upsample=self.upsample)
+            self.origin = self.position.copy()
+            self.count = 0
+        self.time = t
+        return self.position.copy(), rate
+
+
+class Plugin(TemLayer):
+    """Live drift monitor.
+    
+    Frames are captured continuously and the drift rate [nm/s] is plotted.
+    Optionally, the drift is compensated by IS1 or gonio.
+    """
+    menukey = "Plugins/&Pragma Tools/"
+    category = "Pragma Tools"
+    caption = "Drift"
+    
+    def Init(self):
+        self.crop = Param("crop", (256, 512, 1024, 2048), 1024)
+        self.refresh = LParam("refresh", (1, 100, 1), 10)
+        self.history = LParam("history", (10, 1000, 10), 200)
+        
+        self.mode = Choice(self, size=(60,-1),
+                           choices=['none', 'IS1', 'gonio'], readonly=1)
+        self.mode.Selection = 0
+        
+        self.threshold = LParam("threshold [nm]", (0, 100, 0.1), 10)
+        self.gain = LParam("IS1 [bit/nm]", (-100, 100, 0.01), 1.0)
+        self.angle = LParam("rot [deg]", (-180, 180, 0.1), 0)
+        
+        self.layout((
+                self.crop,
+                self.refresh,
+                self.history,
+            ),
+            title="Drift tracking",
+            type='vspin', style='button', cw=-1, lw=48, tw=50,
+        )
+        self.layout((
+                self.mode,
+                self.threshold,
+                self.gain,
+                self.angle,
+            ),
+            title="Compensation", show=0,
+            type='vspin', style='button', cw=-1, lw=80, tw=50,
+        )
+        
+        self.live_btn = ToggleButton(self, "Live", self.toggle_live, icon='camera')
+        
+        self.text = wx.TextCtrl(self, size=(160,40),
+                                style=wx.TE_READONLY|wx.TE_MULTILINE)
+        self.layout((
+                self.live_btn,
+                self.text,
+            ),
+        )
+        self.plot = MatplotPanel(self, log=self.message, size=(300,200))
+        self.layout((self.plot,), expand=2, border=0)
+        
+        self.thread = Thread(self)
+        self.data = []
+    
+    def Destroy(self):
+        self.thread.active = 0
+        return TemLayer.Destroy(self)
+    
+    def toggle_live(self, evt):
+        """Start/Stop drift tracking of live camera frames.
+        
+        The camera system is specified by `camerasys`.
+        """
+        if evt.IsChecked():
+            grabber = self.acquisition
+            if grabber is None:
+                self.message("- No camera to capture:", self.camerasys)
+                self.live_btn.Value = False
+                return
+            self.thread.Start(self.run_live, grabber)
+        else:
+            self.thread.active = 0
+    
+    def run_live(self, grabber):
+        """Track the drift on the newest camera frames.
+        
+        Frames that arrive while processing are dropped except for the newest.
+        The unit length [nm/pix] is taken from the metadata of each frame.
+        """
+        tracker = DriftTracker(int(self.refresh.value))
+        base = np.zeros(2) # position at the last compensation [pix]
+        self.data = []
+        try:
+            grabber.start()
+            u = self.cameraman.frame_info()['localunit'] * 1e6 # [mm/pix] --> [nm/pix]
+            n = 0
+            while self.thread.active and grabber.active:
+                frame = grabber.get(n, timeout=1)
+                if frame is None:
+                    continue
+                buf, t, n = frame
+                meta = grabber.meta(n)
+                if meta:
+                    u = meta['localunit'] * 1e6 # [nm/pix]
+                pos, rate = tracker(edi.fftcrop(buf, self.crop.value), t)
+                if rate is None:
+                    continue
+                self.data.append((t, *(pos * u), *(rate * u)))
+                del self.data[:-int(self.history.value)]
+                
+                d = (pos - base) * u # [nm]
+                if self.mode.Selection > 0 and np.hypot(*d) > self.threshold.value:
+                    self.compensate(d)
+                    tracker.renew()
+                    base = pos
+                wx.CallAfter(self.update_plot)
+        finally:
+            grabber.stop()
+            wx.CallAfter(self.live_btn.SetValue, False)
+    
+    def compensate(self, d):
+        """Compensate the drift d (x, y) [nm] by IS1 or gonio."""
+        t = self.angle.value * pi/180
+        c, s = np.cos(t), np.sin(t)
+        dx, dy = d
+        v = -np.array((c*dx - s*dy, s*dx + c*dy)) # image --> device axes
+        if self.mode.Value == 'IS1':
+            self.tem.IS1 = self.tem.IS1 + v * self.gain.value # [bit]
+        elif self.mode.Value == 'gonio':
+            self.gonio.dX = v[0] * 1e-3 # [um]
+            self.gonio.dY = v[1] * 1e-3
+        self.message("Compensated by {}: {} nm".format(self.mode.Value, np.round(-v, 1)))
+    
+    def update_plot(self):
+        if not self or not self.data:
+            return
+        t, x, y, vx, vy = np.array(self.data).T
+        t = t - t[0]
+        v = np.hypot(vx, vy)
+        self.text.Value = "\n".join((
+            "drift = {:.2f} nm/s".format(v[-1]),
+            "pos = ({:.1f}, {:.1f}) nm".format(x[-1], y[-1]),
+        ))
+        axes = self.plot.axes
+        axes.clear()
+        axes.plot(t, vx, '-', lw=0.5, label='vx')
+        axes.plot(t, vy, '-', lw=0.5, label='vy')
+        axes.plot(t, v, '-', lw=1, label='|v|')
+        axes.set_xlabel("t [s]", fontsize='x-small')
+        axes.set_ylabel("drift [nm/s]", fontsize='x-small')
+        axes.tick_params(labelsize='x-small')
+        axes.legend(fontsize='x-small')
+        axes.grid(True)
+        self.plot.draw()
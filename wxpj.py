@@ -1,7 +1,10 @@
 #! python3
 """GDK utilus ver 1.0rc
 """
+from datetime import datetime
+import threading
 import time
+import weakref
 import numpy as np
 
 from mwx.graphman import Frame, Layer, Thread, Graph # noqa
@@ -9,12 +12,278 @@ from mwx.controls import Param, LParam, ControlPanel, Clipboard, Icon # noqa
 from mwx.controls import Button, ToggleButton, TextBox, Choice, Gauge, Indicator # noqa
 
 
+class FrameGrabber:
+    """Background capture of the latest frame.
+    
+    The producer thread captures frames continuously and keeps only the latest one.
+    Consumers get the newest frame; stale frames are dropped.
+    
+    Args:
+        capture: function that returns a captured buffer
+    
+    >>> grabber = FrameGrabber(camera.cache)
+    >>> grabber.start()
+    >>> buf, t, n = grabber.get()
+    """
+    def __init__(self, capture):
+        self.capture = capture
+        self.active = False
+        self.worker = None
+        self._latest = None # (buf, time, count)
+        self._count = 0
+        self._users = 0
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Start capturing (or join the running producer)."""
+        self._users += 1
+        if self.worker and self.worker.is_alive():
+            return
+        self.active = True
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def stop(self, force=False):
+        """Leave the producer; it stops when no one uses it or if force is True."""
+        self._users = 0 if force else max(0, self._users - 1)
+        if self._users:
+            return
+        self.active = False
+        with self._cond:
+            self._cond.notify_all()
+        if self.worker and self.worker is not threading.current_thread():
+            self.worker.join()
+        self.worker = None
+
+    def _run(self):
+        while self.active:
+            try:
+                buf = self.capture()
+            except Exception as e:
+                print("- Capture failed;", e)
+                self.active = False
+                self._users = 0
+                break
+            if buf is None:
+                continue
+            self._push(buf, time.perf_counter())
+        with self._cond:
+            self._cond.notify_all()
+
+    def _push(self, buf, t):
+        with self._cond:
+            self._count += 1
+            self._latest = (buf, t, self._count)
+            self._cond.notify_all()
+
+    @property
+    def count(self):
+        """Count of the latest frame."""
+        return self._count
+
+    def get(self, last=0, timeout=None):
+        """Get the newest frame captured after the frame count `last`.
+        
+        Returns:
+            (buf, time, count) or None if timed out or stopped.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: not self.active or (self._latest and self._latest[2] > last),
+                    timeout):
+                return None
+            if self._latest and self._latest[2] > last:
+                return self._latest
+            return None
+
+
+class FrameRing(FrameGrabber):
+    """Background acquisition into a ring of pooled frame buffers.
+    
+    The producer thread copies each captured frame into a buffer taken from
+    the pool, and keeps the last `size` frames with the time, count, and metadata.
+    Consumers get the pooled buffers themselves (read-only, zero copy).
+    A buffer is recycled only after it has left the ring and all the
+    references to it (including views, e.g., frames loaded in the graph)
+    have been released, so a frame never changes under its consumers.
+    The release is detected by a finalizer of the buffer memory export,
+    which is kept alive by the buffer and every view of it.
+    
+    Args:
+        capture : function that returns a captured buffer
+        size    : number of frames in the ring
+        info    : function that returns the acquisition metadata (dict)
+        maxpool : maximum number of buffers in the pool
+                  If all buffers are in use, a new one is allocated out of the pool.
+    
+    >>> ring = FrameRing(camera.cache, 4)
+    >>> ring.start()
+    >>> buf, t, n = ring.get()
+    >>> meta = ring.meta(n)
+    """
+    def __init__(self, capture, size=4, info=None, maxpool=16):
+        FrameGrabber.__init__(self, capture)
+        self.size = size
+        self.info = info
+        self.maxpool = maxpool
+        self._pooled = 0 # number of memory blocks owned by the pool
+        self._free = [] # released memory blocks
+        self._ring = [] # [(buf, time, count, meta)] oldest first
+
+    def _take(self, shape, dtype):
+        """Lease a buffer from the pool, or allocate a new one."""
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with self._cond:
+            while self._free:
+                mem = self._free.pop()
+                if mem.nbytes == nbytes:
+                    break
+                self._pooled -= 1 # drop the block of an old shape (binning etc.)
+            else:
+                if self._pooled >= self.maxpool:
+                    return np.empty(shape, dtype) # out of the pool
+                mem = np.empty(nbytes, np.uint8)
+                self._pooled += 1
+        flat = np.frombuffer(memoryview(mem), dtype)
+        ## flat.base is the memoryview of mem, which all views refer to.
+        f = weakref.finalize(flat.base, self._release, mem)
+        f.atexit = False
+        return flat.reshape(shape)
+
+    def _release(self, mem):
+        with self._cond:
+            self._free.append(mem)
+
+    def _push(self, buf, t):
+        meta = self.info() if self.info else {}
+        with self._cond:
+            dst = self._take(buf.shape, buf.dtype)
+        np.copyto(dst, buf)
+        dst.flags.writeable = False
+        with self._cond:
+            self._count += 1
+            self._ring.append((dst, t, self._count, meta))
+            del self._ring[:-self.size]
+            self._latest = (dst, t, self._count)
+            self._cond.notify_all()
+
+    def meta(self, n):
+        """Metadata of the frame count n, or None if it has left the ring."""
+        with self._cond:
+            for _buf, _t, count, meta in self._ring:
+                if count == n:
+                    return meta
+
+    def frames(self):
+        """Frames in the ring (oldest first).
+        
+        Returns:
+            list of (buf, time, count) without copy.
+        """
+        with self._cond:
+            return [(buf, t, n) for buf, t, n, _meta in self._ring]
+
+    @property
+    def pooled(self):
+        """Number of buffers in the pool and those in use."""
+        with self._cond:
+            return self._pooled, self._pooled - len(self._free)
+
+
 class Layer(Layer):
     import editor as edi
 
     su = property(lambda self: self.parent.require('startup'))
 
 
+class CameraLayer(Layer):
+    """Layer of camera manager with the acquisition engine.
+    
+    The camera plugin supplies `camera`, `connect`, and its own parameters,
+    and overrides `grab` if the camera has no `cache` method.
+    """
+    camera = None
+    ring_size = 4 # number of frames in the acquisition ring
+    
+    _acquisition = None
+    
+    @property
+    def acquisition(self):
+        """Acquisition engine <FrameRing> of the camera."""
+        if self._acquisition is None:
+            self._acquisition = FrameRing(self.grab, self.ring_size, info=self.frame_info)
+        return self._acquisition
+    
+    def Destroy(self):
+        if self._acquisition:
+            self._acquisition.stop(force=True)
+        return Layer.Destroy(self)
+    
+    def connect(self):
+        raise NotImplementedError
+    
+    def grab(self):
+        """Acquire an image synchronously (blocks for exposure and transfer)."""
+        return self.camera.cache()
+    
+    def frame_info(self):
+        """Acquisition metadata of the current frame."""
+        return {
+            'localunit' : self.camera.pixel_unit,
+               'camera' : self.camera.name,
+                'pixel' : self.camera.pixel_size,
+              'binning' : self.camera.binning,
+             'exposure' : self.camera.exposure,
+         'acq_datetime' : datetime.now(),
+        }
+    
+    def capture(self, view=False, **kwargs):
+        """Capture image.
+        
+        Args:
+            view    : If True, the buffer will be loaded into the graph view.
+            **kwargs: Additional attributes of the buffer frame.
+                      Used only if view is True.
+        """
+        if self.acquisition.active:
+            ## Read the first frame exposed after the call (zero copy).
+            ## Note: The frame n0+1 may have been exposing before the call.
+            n0 = self.acquisition.count
+            frame = self.acquisition.get(n0 + 1, timeout=max(2, 4 * self.camera.exposure))
+            if frame is None:
+                return None
+            buf, _t, n = frame
+            attributes = self.acquisition.meta(n) or self.frame_info()
+        else:
+            if not self.camera:
+                if not self.connect():
+                    return None
+            buf = self.grab()
+            attributes = self.frame_info()
+        if view and buf is not None:
+            frame = self.graph.load(buf, **attributes, **kwargs)
+            self.parent.handler('frame_cached', frame)
+        return buf
+    
+    def capture_ex(self):
+        """Capture image and load into the graph view."""
+        return self.capture(True)
+    
+    def toggle_prefetch(self, evt):
+        """Start/Stop the background acquisition into the ring buffer.
+        
+        While prefetching, capture returns the first frame exposed after the call
+        from the ring, so that the optics/exposure changed before are reflected.
+        """
+        if evt.IsChecked():
+            if not self.camera and not self.connect():
+                evt.EventObject.Value = False
+                return
+            self.acquisition.start()
+        else:
+            self.acquisition.stop()
+
+
 class TemLayer(Layer):
     """Layer with TEM notify and detector interface.
     """
@@ -57,6 +326,15 @@ class TemLayer(Layer):
         """
         return self.cameraman.capture(view, **kwargs) # output array is read-only.
 
+    @property
+    def acquisition(self):
+        """Acquisition engine <FrameRing> of the camera system.
+        
+        Live plugins share it by start/stop.
+        """
+        if self.camera: # connect if not yet
+            return self.cameraman.acquisition
+
     default_delay = 0.5     # delay time before exposing (till afterglow vanishes)
     signal_level = 20       # [counts]
     noise_level = 2         # [counts]
@@ -107,10 +385,10 @@ class TemLayer(Layer):
             delays = self.default_delay
         self.delay(max(t, delays))
         
-        src = self.capture().copy()
+        src = self.capture() # read-only
         
         if isinstance(cache, np.ndarray): # integrate the cached buffer
-            src += cache
+            src = src + cache # copy-on-write
             t += cache_t
             cache = (t < self.MAX_EXPOSURE) # True while exposure < 1s
             self.message(f"Cached exposure {t:g} sec.")